@@ -1,11 +1,23 @@
 
-import xml.dom.minidom
-import itertools
+from xml.etree import ElementTree
+import hashlib
+import heapq
+import instrumentation
+import os
+import tempfile
+import threading
+import time
+import numpy as np
 
 
 class BayesianNet(object):
     """
     Class of Bayesian Network
+
+    Every node gets a dense integer ID (its position in the node list) and is
+    registered in a name -> ID dictionary. Parent and child lists are mirrored
+    as integer arrays on the nodes and a topological order is cached; both are
+    rebuilt lazily after the structure changes.
     """
     def __init__(self, name):
         """
@@ -13,21 +25,42 @@ class BayesianNet(object):
         """
         self.name = name
         self.nodes = []
+        self.index = {}
+        self.order = None
 
     def add_node(self, node):
         """
         Add a node to the network
         """
+        node.id = len(self.nodes)
+        self.index[node.name] = node.id
         self.nodes.append(node)
+        self.order = None
+
+    def add_edge(self, parent, child):
+        """
+        Add an edge between two nodes of the network, given by name
+        """
+        cardinality = self.nodes[self.index[parent]].get_cardinality()
+        self.nodes[self.index[child]].add_parent(parent, cardinality)
+        self.nodes[self.index[parent]].add_child(child)
+        self.order = None
 
     def get_node(self, target_name):
         """
         Input: a node name
         Output: the corresponding node object
         """
-        for node in self.nodes:
-            if node.name == target_name:
-                return node
+        i = self.index.get(target_name)
+        if i is not None:
+            return self.nodes[i]
+
+    def get_id(self, target_name):
+        """
+        Input: a node name
+        Output: the integer ID of the node
+        """
+        return self.index[target_name]
 
     def get_nodelist(self):
         """
@@ -35,20 +68,170 @@ class BayesianNet(object):
         """
         return self.nodes
 
+    def index_graph(self):
+        """
+        Rebuild the integer parent/child arrays of every node and the
+        topological order. Ties are broken by ID, so a node list that is
+        already topologically sorted keeps its order.
+        """
+        for node in self.nodes:
+            node.parent_ids = np.array([self.index[p] for p in node.parents], dtype=np.int32)
+            node.child_ids = np.array([self.index[c] for c in node.children], dtype=np.int32)
+            node.parent_cards = [self.nodes[p].get_cardinality() for p in node.parent_ids]
+        pending = [len(node.parents) for node in self.nodes]
+        ready = [i for i in range(len(self.nodes)) if pending[i] == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            i = heapq.heappop(ready)
+            order.append(i)
+            for c in self.nodes[i].child_ids:
+                pending[c] -= 1
+                if pending[c] == 0:
+                    heapq.heappush(ready, int(c))
+        if len(order) != len(self.nodes):
+            raise ValueError("The network %s contains a cycle" % self.name)
+        self.order = order
+
+    def topological_order(self):
+        """
+        Get the IDs of all the nodes, parents before children
+        """
+        if self.order is None:
+            self.index_graph()
+        return self.order
+
+    def evidence_states(self, e):
+        """
+        Input:
+            e, evidence mapping names to True/False, outcome names or state indexes
+        Output:
+            the evidence mapping names to state indexes
+        """
+        res = {}
+        for name in e:
+            res[name] = self.get_node(name).state_index(e[name])
+        return res
+
+    def get_sorted_nodelist(self):
+        """
+        Get a list of all the node objects, parents before children
+        """
+        return [self.nodes[i] for i in self.topological_order()]
+
+    def ancestors(self, names):
+        """
+        Get the set of the given nodes and all their ancestors
+        """
+        res = set(names)
+        stack = list(names)
+        while stack:
+            for parent in self.get_node(stack.pop()).parents:
+                if parent not in res:
+                    res.add(parent)
+                    stack.append(parent)
+        return res
+
+    def requisite_evidence(self, query, e):
+        """
+        Bayes-ball (Shachter, 1998): find the evidence that is not d-separated
+        from the query
+        Input:
+            query, a list of query variables
+            e, observed values for variables E
+        Output:
+            the part of e that can influence the query
+        """
+        top = set()
+        bottom = set()
+        visited = set()
+        # Each entry is (node, whether the ball comes from one of its children)
+        schedule = [(q, True) for q in query]
+        while schedule:
+            name, from_child = schedule.pop()
+            visited.add(name)
+            node = self.get_node(name)
+            if from_child and name not in e:
+                if name not in top:
+                    top.add(name)
+                    schedule.extend((p, True) for p in node.parents)
+                if name not in bottom:
+                    bottom.add(name)
+                    schedule.extend((c, False) for c in node.children)
+            elif not from_child:
+                if name in e:
+                    if name not in top:
+                        top.add(name)
+                        schedule.extend((p, True) for p in node.parents)
+                elif name not in bottom:
+                    bottom.add(name)
+                    schedule.extend((c, False) for c in node.children)
+        res = {}
+        for name in e:
+            if name in visited:
+                res[name] = e[name]
+        return res
+
+    def prune(self, query, e):
+        """
+        Reduce the network to the part that can affect P(query | e)
+        Input:
+            query, a query variable or a list of them
+            e, observed values for variables E
+        Output:
+            the pruned Bayesian network, which any inference algorithm can be
+            run on instead of this one,
+            the evidence that is not d-separated from the query
+
+        The evidence is first filtered with Bayes-ball; the network is then
+        restricted to the ancestors of the query and the remaining evidence,
+        since every other node is barren and sums out to one.
+        """
+        if isinstance(query, str):
+            query = [query]
+        e = self.requisite_evidence(query, e)
+        keep = self.ancestors(list(query) + list(e))
+        res = BayesianNet(self.name)
+        for node in self.nodes:
+            if node.name in keep:
+                temp_node = Node(node.name)
+                temp_node.outcomes = list(node.outcomes)
+                temp_node.probabilities = node.probabilities
+                temp_node.cpt = node.cpt
+                res.add_node(temp_node)
+        for node in self.nodes:
+            if node.name in keep:
+                for parent in node.parents:
+                    res.add_edge(parent, node.name)
+        res.index_graph()
+        return res, e
+
 
 class Node(object):
     """
     Class of Node
+
+    A node has k states, one per OUTCOME (two when no outcome is listed).
+    States are referred to by index; for a binary node True is state 0 and
+    False is state 1, matching the outcome order true/false of the XML files.
     """
+    __slots__ = ("name", "id", "parents", "children", "parent_ids", "child_ids",
+                 "parent_cards", "outcomes", "probabilities", "cpt")
+
     def __init__(self, name):
         """
         Initialization
         """
         self.name = name
+        self.id = -1
+        self.parent_ids = np.zeros(0, dtype=np.int32)
+        self.child_ids = np.zeros(0, dtype=np.int32)
+        self.parent_cards = []
         self.parents = []
         self.children = []
         self.outcomes = []
         self.probabilities = []
+        self.cpt = np.zeros((0, 2))
 
     def add_outcome(self, name):
         """
@@ -56,43 +239,120 @@ class Node(object):
         """
         self.outcomes.append(name)
 
+    def get_cardinality(self):
+        """
+        Get the number of states of the node
+        """
+        return len(self.outcomes) or 2
+
+    def state_index(self, value):
+        """
+        Input:
+            a value of the node: True/False (binary nodes), an outcome name
+            or a state index
+        Output:
+            the corresponding state index
+        """
+        if isinstance(value, (bool, np.bool_)):
+            return 0 if value else 1
+        if isinstance(value, str):
+            for i, outcome in enumerate(self.outcomes):
+                if outcome.lower() == value.lower():
+                    return i
+            if self.get_cardinality() == 2 and value.lower() in ("true", "false"):
+                return 0 if value.lower() == "true" else 1
+            if value.isdigit():
+                return int(value)
+            raise ValueError("%s is not an outcome of %s" % (value, self.name))
+        return int(value)
+
+    def state_value(self, index):
+        """
+        Input:
+            a state index
+        Output:
+            the value of the node: True/False for a binary node, the outcome
+            name otherwise
+        """
+        if self.get_cardinality() == 2:
+            return index == 0
+        return self.outcomes[index]
+
     def set_probabilities(self, p=[]):
         """
         Set the probabilities (conditional probability table) for the node
+        and compile them into a numeric CPT
         """
         self.probabilities = p[:]
+        self.compile_cpt()
+
+    def compile_cpt(self):
+        """
+        Parse the probability strings once into a contiguous float array.
+        Row i holds the distribution of the node given the parent assignment
+        whose mixed-radix index is i (the last parent varying fastest, as in
+        XMLBIF tables), and column j is state j of the node.
+        """
+        rows = [[float(v) for v in line.split()] for line in self.probabilities]
+        self.cpt = np.ascontiguousarray(rows, dtype=np.float64).reshape(-1, self.get_cardinality())
+        return self.cpt
+
+    def get_index(self, parents=[]):
+        """
+        Input:
+            a list of parent values (True/False or state indexes), in the
+            order of get_parent()
+        Output:
+            the row of the compiled CPT for this parent assignment
+        """
+        # Horner's rule over the parent cardinalities: the scalar form of
+        # assignment_to_index, without building arrays on the hot path
+        index = 0
+        for p, card in zip(parents, self.parent_cards):
+            index = index * card + to_state(p)
+        return index
+
+    def lookup(self, node, index):
+        """
+        O(1) lookup of P(node | parents) given the parent assignment index
+        """
+        return self.cpt[index, self.state_index(node)]
+
+    def get_probability_batch(self, node, parent_states):
+        """
+        Batched lookup
+        Input:
+            node, the value of the node: a value or an array of values
+            parent_states, an array of shape (N, number of parents) holding
+                state indexes (or True/False for binary parents)
+        Output:
+            an array holding P(node | parents) for each of the N rows
+        """
+        if not self.parent_cards:
+            # A root node has a single CPT row, whatever the (empty) rows say
+            n = len(parent_states) if len(parent_states) else np.size(node)
+            index = np.zeros(n, dtype=np.intp)
+        else:
+            parent_states = to_states(parent_states).reshape(-1, len(self.parent_cards))
+            index = assignment_to_index(parent_states, self.parent_cards)
+        if np.ndim(node) == 0:
+            column = self.state_index(node)
+        else:
+            column = to_states(node)
+        return self.cpt[index, column]
 
     def get_probability(self, node, parents=[]):
         """
         Get the conditional/prior probability of the node
         """
-        if not parents:
-            """
-            Get prior probability
-            """
-            if node:
-                return float(self.probabilities[0].split()[0])
-            else:
-                return float(self.probabilities[0].split()[1])
-        else:
-            """
-            Get conditional probability
-            """
-            n = len(parents) - 1
-            index = 0
-            for p in parents:
-                index += 2**n if p is False else 0
-                n -= 1
-            if node:
-                return float(self.probabilities[index].split()[0])
-            else:
-                return float(self.probabilities[index].split()[1])
+        return float(self.cpt[self.get_index(parents), self.state_index(node)])
 
-    def add_parent(self, parent):
+    def add_parent(self, parent, cardinality=2):
         """
         Add parents to the node
         """
         self.parents.append(parent)
+        self.parent_cards.append(cardinality)
 
     def add_child(self, child):
         """
@@ -125,104 +385,381 @@ class Node(object):
         return self.children
 
 
+def ask_pruned(engine, x, e, bn, *args, **kwargs):
+    """
+    Run an inference algorithm on the part of bn relevant to the query
+    Input:
+        engine, enumerate_ask, elimination_ask, rejection_sampling,
+            likelihood_weighting, gibbs_ask or any function (x, e, bn, ...)
+        x, the query variable
+        e, observed values for variables E
+        bn, a Bayesian network
+        args, kwargs, passed on to engine
+    Output:
+        the result of engine on the pruned network
+    """
+    sub_bn, sub_e = bn.prune(x, e)
+    return engine(x, sub_e, sub_bn, *args, **kwargs)
+
+
+def to_state(value):
+    """
+    Convert True/False or a state index into a state index
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return 0 if value else 1
+    return int(value)
+
+
+def to_states(values):
+    """
+    Convert an array of True/False values or state indexes into state indexes
+    """
+    values = np.asarray(values)
+    if values.dtype == bool:
+        return (~values).astype(np.intp)
+    return values.astype(np.intp)
+
+
+def sample_states(rows, u):
+    """
+    Categorical sampling
+    Input:
+        rows, an array of shape (N, k) holding one distribution per row
+        u, an array of N uniform draws in [0, 1)
+    Output:
+        the sampled state index of every row
+    """
+    cum = np.cumsum(rows, axis=1)
+    return (u[:, None] >= cum[:, :-1]).sum(axis=1).astype(np.uint8)
+
+
+def sample_state(row, u):
+    """
+    Categorical sampling of a single state, with the same convention as
+    sample_states: the first state whose cumulative probability exceeds u
+    """
+    total = 0.0
+    for s, p in enumerate(row):
+        total += p
+        if u < total:
+            return s
+    return len(row) - 1
+
+
+class UniformStream(object):
+    """
+    Class of buffered uniform draws: uniforms are drawn from a numpy
+    Generator in blocks and handed out a few at a time, so code drawing one
+    sample at a time does not pay for a Generator call per draw. The stream
+    is deterministic given its seed, whatever sizes are requested.
+    """
+    def __init__(self, rng=None, block=4096):
+        """
+        Initialization
+        Input:
+            rng, a numpy Generator, SeedSequence, seed or None (fresh entropy)
+            block, the number of uniforms drawn at once
+        """
+        self.rng = np.random.default_rng(rng)
+        self.block = block
+        self.buffer = np.zeros(0)
+        self.position = 0
+
+    def random(self, n=None):
+        """
+        Get one uniform draw in [0, 1) (as a float) or an array of n of them
+        """
+        size = 1 if n is None else n
+        if self.position + size > len(self.buffer):
+            self.buffer = np.concatenate([self.buffer[self.position:],
+                                          self.rng.random(max(self.block, size))])
+            self.position = 0
+        res = self.buffer[self.position: self.position + size]
+        self.position += size
+        return float(res[0]) if n is None else res
+
+    def integers(self, k):
+        """
+        Get a state index drawn uniformly from range(k)
+        """
+        return min(int(self.random() * k), k - 1)
+
+    def spawn(self, n):
+        """
+        Get n independent streams
+        """
+        return [UniformStream(rng, self.block) for rng in self.rng.spawn(n)]
+
+
+# The streams of the single-sample functions when they are given no
+# generator: one per thread, so threads never share a buffer, and renewed
+# in a forked process, so children do not replay their parent's draws
+local_streams = threading.local()
+
+
+def uniform_source(rng=None):
+    """
+    Input:
+        a UniformStream, a numpy Generator, a SeedSequence, a seed, or None
+    Output:
+        something with a random(n) method: the stream itself, a Generator,
+        or (for None) a freshly seeded stream owned by the calling thread
+    """
+    if isinstance(rng, UniformStream):
+        return rng
+    if rng is None:
+        if getattr(local_streams, "pid", None) != os.getpid():
+            local_streams.stream = UniformStream()
+            local_streams.pid = os.getpid()
+        return local_streams.stream
+    return np.random.default_rng(rng)
+
+
+def parse_evidence(bn, args):
+    """
+    Input:
+        bn, a Bayesian network
+        args, a flat list of command line arguments: name value name value ...
+            where each value is an outcome name, true/false or a state index
+    Output:
+        the evidence as a dictionary mapping names to state indexes
+    """
+    e = {}
+    for index in range(0, len(args), 2):
+        e[args[index]] = bn.get_node(args[index]).state_index(args[index+1])
+    return e
+
+
 def xml_reader(filename, name):
     """
     The XML parser: Read a XML file and fit it into a Bayesian Network
+
+    The file is streamed with iterparse and every VARIABLE and DEFINITION is
+    detached from its parent once it has been read, so the whole document is
+    never held in memory.
     """
     bn = BayesianNet(name)
-    document = xml.dom.minidom.parse(filename)
-    node_y = {}
-    y = []
-    node_x = {}
-    x = []
-    """
-    Parse data with tag: VARIABLE
-    """
-    for variable in document.getElementsByTagName("VARIABLE"):
-        node_name = variable.getElementsByTagName("NAME")[0].childNodes[0].nodeValue
-        outcomes = variable.getElementsByTagName("OUTCOME")
-        properties = variable.getElementsByTagName("PROPERTY")
-        temp_node = Node(node_name)
-        for outcome in outcomes:
-            o = outcome.childNodes[0].nodeValue
-            temp_node.add_outcome(o)
-        if not properties:
-            bn.add_node(temp_node)
+    positioned = []
+    definitions = []
+    # The open elements, so that a finished one can be removed from its parent
+    stack = []
+    for event, element in ElementTree.iterparse(filename, events=("start", "end")):
+        if event == "start":
+            stack.append(element)
+            continue
+        stack.pop()
+        if element.tag == "VARIABLE":
+            temp_node = Node(element.findtext("NAME").strip())
+            for outcome in element.iter("OUTCOME"):
+                temp_node.add_outcome(outcome.text.strip())
+            position = None
+            for prop in element.iter("PROPERTY"):
+                if prop.text.strip().startswith("position"):
+                    position = prop.text
+                    break
+            if position is None:
+                bn.add_node(temp_node)
+            else:
+                x, y = position[position.index('(')+1: position.rindex(')')].split(',')
+                positioned.append((int(y), int(x), len(positioned), temp_node))
+        elif element.tag == "DEFINITION":
+            given = [g.text.strip() for g in element.iter("GIVEN")]
+            definitions.append((element.findtext("FOR").strip(), given,
+                                element.findtext("TABLE").split()))
         else:
-            node_position = properties[0].childNodes[0].nodeValue
-            pos_comma = node_position.index(',')
-            open_p = node_position.index('(')
-            height = int(node_position[pos_comma+1: -1])
-            node_y[temp_node] = height
-            y.append(height)
-            width = int(node_position[open_p+1: pos_comma])
-            node_x[temp_node] = width
-            x.append(width)
-    """
-    Handle special case for dog-problem in which each variable has a coordinate
-    """
-    if y:
-        set_y = set(y)
-        sorted_list_y = sorted(set_y)
-        set_x = set(x)
-        sorted_list_x = sorted(set_x)
-        for h in sorted_list_y:
-            # node objects of the same height
-            same_y_nodes = []
-            for node_object in node_y:
-                if node_y[node_object] == h:
-                    same_y_nodes.append(node_object)
-            for w in sorted_list_x:
-                for node_object in same_y_nodes:
-                    if node_x[node_object] == w:
-                        bn.add_node(node_object)
-
-    """
-    Parse data with Tag DEFINITION
-    """
-    for definition in document.getElementsByTagName("DEFINITION"):
-        node_name = definition.getElementsByTagName("FOR")[0].childNodes[0].nodeValue
-        evidence = definition.getElementsByTagName("GIVEN")
-        table = definition.getElementsByTagName("TABLE")[0]
+            continue
+        if stack:
+            stack[-1].remove(element)
+    """
+    Handle special case for dog-problem in which each variable has a coordinate:
+    such nodes are added top to bottom, then left to right
+    """
+    for y, x, i, temp_node in sorted(positioned, key=lambda item: item[:3]):
+        bn.add_node(temp_node)
+    for node_name, given, table in definitions:
+        for e_name in given:
+            bn.add_edge(e_name, node_name)
         temp_node = bn.get_node(node_name)
-        for e in evidence:
-            e_name = e.childNodes[0].nodeValue
-            temp_node.add_parent(e_name)
-            parent_node = bn.get_node(e_name)
-            parent_node.add_child(node_name)
-        p = get_text(table.childNodes)
-        if not y:
-            temp_node.set_probabilities(list(filter(None, p)))
-        else:
-            p_elements = p[0].split()
-            right_format = []
-            for i in range(0, len(p_elements), 2):
-                item = p_elements[i] + ' ' + p_elements[i+1]
-                right_format.append(item)
-            temp_node.set_probabilities(right_format)
+        k = temp_node.get_cardinality()
+        temp_node.set_probabilities([' '.join(table[i: i+k]) for i in range(0, len(table), k)])
+    bn.index_graph()
     return bn
 
 
-def get_text(nodelist):
+def file_digest(filename):
     """
-    Transform the data in nodelist into proper text form
+    SHA-256 of a file, read in chunks
     """
-    res = []
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            res.append(node.data.strip(' \t\n\r'))
-    return res
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+CACHE_VERSION = 1
+
+
+@instrumentation.instrumented("load", label="network")
+def load_network(filename, name, cache_dir=None):
+    """
+    Load a network through the compiled-network cache
+    Input:
+        filename, an XMLBIF file
+        name, the name of the Bayesian network
+        cache_dir, where compiled networks are kept (default: a __bncache__
+            directory next to the file)
+    Output:
+        a Bayesian network
+
+    The cache entry is keyed by the hash of the XML file, so an edited file is
+    parsed again; an unchanged one is rebuilt from its arrays without XML.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), "__bncache__")
+    record = instrumentation.active()
+    if record is not None:
+        t = time.perf_counter()
+    path = os.path.join(cache_dir, "%s-v%d.npz" % (file_digest(filename), CACHE_VERSION))
+    if os.path.exists(path):
+        bn = read_compiled(path, name)
+        if record is not None:
+            instrumentation.lap(record, "load", t)
+            record.count("cache_hits")
+        return bn
+    bn = xml_reader(filename, name)
+    try:
+        write_cache(bn, cache_dir, path)
+    except OSError:
+        # The cache is only an optimization: a read-only directory or a full
+        # disk leaves the network uncached
+        pass
+    if record is not None:
+        instrumentation.lap(record, "load", t)
+        record.count("cache_misses")
+    return bn
+
+
+def write_cache(bn, cache_dir, path):
+    """
+    Save a compiled network as the cache entry path of cache_dir. It is
+    written to a temporary file of its own first, so a concurrent reader
+    never sees a partial entry and concurrent writers (threads or processes)
+    never share a file; the last rename wins, with identical contents.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".npz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_compiled(bn, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def write_compiled(bn, path):
+    """
+    Save a Bayesian network, to a path or an open binary file, as flat
+    arrays: names, outcomes, parents (as offsets into one array of IDs) and
+    CPT values (as offsets into one array)
+    """
+    nodes = bn.get_nodelist()
+    outcome_ptr = np.cumsum([0] + [len(node.outcomes) for node in nodes])
+    parent_ptr = np.cumsum([0] + [len(node.parents) for node in nodes])
+    cpt_ptr = np.cumsum([0] + [node.cpt.size for node in nodes])
+    np.savez(path,
+             names=np.array([node.name for node in nodes], dtype=str),
+             outcomes=np.array([o for node in nodes for o in node.outcomes], dtype=str),
+             outcome_ptr=outcome_ptr,
+             parents=np.array([bn.get_id(p) for node in nodes for p in node.parents], dtype=np.int32),
+             parent_ptr=parent_ptr,
+             cpt=np.concatenate([node.cpt.ravel() for node in nodes] + [np.zeros(0)]),
+             cpt_ptr=cpt_ptr)
+
+
+def read_compiled(path, name):
+    """
+    Rebuild a Bayesian network saved by write_compiled
+    """
+    with np.load(path) as data:
+        names = data["names"].tolist()
+        outcomes = data["outcomes"].tolist()
+        outcome_ptr, parent_ptr, cpt_ptr = data["outcome_ptr"], data["parent_ptr"], data["cpt_ptr"]
+        parents, cpt = data["parents"], data["cpt"]
+    bn = BayesianNet(name)
+    for i, node_name in enumerate(names):
+        temp_node = Node(node_name)
+        temp_node.outcomes = outcomes[outcome_ptr[i]: outcome_ptr[i+1]]
+        bn.add_node(temp_node)
+    for i, node_name in enumerate(names):
+        for p in parents[parent_ptr[i]: parent_ptr[i+1]]:
+            bn.add_edge(names[p], node_name)
+        temp_node = bn.nodes[i]
+        k = temp_node.get_cardinality()
+        temp_node.cpt = cpt[cpt_ptr[i]: cpt_ptr[i+1]].reshape(-1, k)
+        temp_node.probabilities = [' '.join(repr(v) for v in row) for row in temp_node.cpt.tolist()]
+    bn.index_graph()
+    return bn
 
 
 class Factor(object):
     """
-    Class of factor
+    Class of factor: a dense table stored as an n-dimensional array with
+    one named axis per variable, indexed by the states of the variable
+    (for a binary variable index 0 is True, index 1 is False)
     """
-    def __init__(self):
-        self.node_name = ''
-        self.prob_table = []
-        self.parents = []
-        self.hidden_val = []
+    def __init__(self, variables=[], values=None):
+        self.variables = list(variables)
+        if values is None:
+            values = np.ones((2,) * len(self.variables))
+        self.values = np.asarray(values, dtype=np.float64)
+
+    def axis(self, var):
+        """
+        Get the axis of the array that corresponds to var
+        """
+        return self.variables.index(var)
+
+    def index(self, assignment):
+        """
+        Input:
+            a dictionary mapping the variables of this factor to state indexes
+        Output:
+            the flat index of that entry of the table
+        """
+        return int(assignment_to_index([assignment[v] for v in self.variables], self.values.shape))
+
+    def assignment(self, index):
+        """
+        Input:
+            a flat index into the table
+        Output:
+            the corresponding dictionary mapping variables to state indexes
+        """
+        states = index_to_assignment(index, self.values.shape).tolist()
+        return dict(zip(self.variables, states))
+
+    def get_probability(self, assignment):
+        """
+        The entry of the table for an assignment of all its variables
+        """
+        return float(self.values.flat[self.index(assignment)])
+
+    def expand(self, variables):
+        """
+        Input:
+            an ordered list of variables containing all variables of this factor
+        Output:
+            the values of this factor transposed into that order, with a
+            length-1 axis for every variable the factor does not mention, so
+            that it broadcasts against any factor over the same variables
+        """
+        present = [v for v in variables if v in self.variables]
+        values = np.transpose(self.values, [self.axis(v) for v in present])
+        shape = [self.values.shape[self.axis(v)] if v in self.variables else 1 for v in variables]
+        return values.reshape(shape)
 
 
 def make_factor(node_object, e):
@@ -230,56 +767,102 @@ def make_factor(node_object, e):
     Initialize a factor
     Input:
         A node object,
-        evidence
+        evidence, as True/False or state indexes (see BayesianNet.evidence_states)
     Output:
-        A factor
-    """
-    f = Factor()
-    f.node_name = node_object.get_name()
-    f.parents = node_object.get_parent()
-    if f.node_name not in e:
-        f.hidden_val.append(f.node_name)
-    for parent in f.parents:
-        if parent not in e:
-            f.hidden_val.append(parent)
-    cnt_e = len(f.hidden_val)
-    permutation = generate_permutation(cnt_e)
-    for i in range(len(permutation)):
-        index = 0
-        perm = []
-        line = []
-        x = f.node_name
-        record = {}
-        if x in e:
-            perm.append(e[x])
-            record[x] = e[x]
-        else:
-            perm.append(permutation[i][index])
-            record[x] = permutation[i][index]
-            index += 1
-        for parent in f.parents:
-            if parent in e:
-                perm.append(e[parent])
-                record[parent] = e[parent]
-            else:
-                perm.append(permutation[i][index])
-                record[parent] = permutation[i][index]
-                index += 1
-        prob = node_object.get_probability(perm[0], perm[1:])
-        line.append(record)
-        line.append(prob)
-        f.prob_table.append(line)
-    return f
+        A factor over the variables of the node's CPT that are not in the evidence
+    """
+    node_name = node_object.get_name()
+    parents = node_object.get_parent()
+    # The CPT rows are indexed in mixed radix over the parents, so a C-order
+    # reshape gives one axis per parent followed by the axis of the node itself
+    values = node_object.cpt.reshape(tuple(node_object.parent_cards) + (node_object.get_cardinality(),))
+    values = np.moveaxis(values, -1, 0)
+    variables = [node_name] + list(parents)
+    index = tuple(to_state(e[v]) if v in e else slice(None) for v in variables)
+    hidden = [v for v in variables if v not in e]
+    return Factor(hidden, values[index])
 
 
-def generate_permutation(length):
+def strides(cards):
     """
-    Generate a permutation of True/False with given length
+    Input:
+        the cardinalities of an ordered list of variables
+    Output:
+        the stride of each variable in the flat index of a table over them,
+        the last variable varying fastest
     """
-    perms = set()
-    for comb in itertools.combinations_with_replacement([True, False], length):
-        for perm in itertools.permutations(comb):
-            perms.add(perm)
-    perms = list(perms)
-    return perms
+    res = np.ones(len(cards), dtype=np.int64)
+    for i in range(len(cards) - 2, -1, -1):
+        res[i] = res[i+1] * cards[i+1]
+    return res
 
+
+def assignment_to_index(assignment, cards):
+    """
+    Input:
+        assignment, the state index of each variable, or an array of shape
+            (N, number of variables) holding one assignment per row
+        cards, the cardinalities of the variables
+    Output:
+        the flat index of the assignment(s)
+    """
+    return np.asarray(assignment, dtype=np.int64) @ strides(cards)
+
+
+def parent_rows(sampled, parents, cards, n):
+    """
+    The CPT row of a node for each of a batch of samples
+    Input:
+        sampled, the states drawn so far: a dictionary mapping names to
+            arrays of state indexes, or an array of shape (n, variables)
+            with one column per node ID
+        parents, the parents of the node: names for a dictionary, IDs for
+            an array
+        cards, the cardinalities of the parents
+        n, the number of samples
+    Output:
+        an array holding the CPT row of every sample
+
+    This is assignment_to_index on the parent columns (last parent varying
+    fastest), by Horner's rule one column at a time rather than on a stacked
+    copy of them; it is also called on single rows, so it stays free of
+    per-call array setup.
+    """
+    index = np.zeros(n, dtype=np.intp)
+    if not isinstance(sampled, dict):
+        sampled = sampled.T
+    for p, card in zip(parents, cards):
+        index = index * card + sampled[p]
+    return index
+
+
+def index_to_assignment(index, cards):
+    """
+    Input:
+        index, a flat index, or an array of them
+        cards, the cardinalities of the variables
+    Output:
+        the state index of each variable, with one row per index if an
+        array was given
+    """
+    index = np.asarray(index, dtype=np.int64)
+    return (index[..., None] // strides(cards)) % np.asarray(cards, dtype=np.int64)
+
+
+def generate_permutation(length, cards=None):
+    """
+    Generate every assignment of length variables, in flat index order
+    Input:
+        length, the number of variables
+        cards, their cardinalities (default: binary variables)
+    Output:
+        a list of tuples; for binary variables the values are True/False
+    """
+    if cards is None:
+        cards = [2] * length
+    cards = list(cards)
+    size = int(np.prod(cards, dtype=np.int64))
+    table = index_to_assignment(np.arange(size), cards).reshape(size, length)
+    if all(c == 2 for c in cards):
+        return [tuple(bool(v == 0) for v in row) for row in table.tolist()]
+    return [tuple(row) for row in table.tolist()]
@@ -0,0 +1,283 @@
+import BayesianNetwork
+import math
+import time
+import numpy as np
+from gibbs_sampling import effective_sample_size, gibbs_chain, state_r_hat
+from likelihood_weighting import importance_sample_batch, log_bincount, weighted_sample_batch
+from rejection_sampling import prior_sample_batch
+import sys
+
+
+class Estimate(object):
+    """
+    Class of running estimate of P(X|e) produced by a sampling stream
+    """
+    def __init__(self, distribution, std_error, ess, samples, elapsed, extra=None):
+        """
+        Initialization
+        Input:
+            distribution, the current (unrounded) estimate of P(X|e)
+            std_error, the standard error of every entry
+            ess, the effective sample size
+            samples, the number of samples generated so far
+            elapsed, the seconds spent since the stream started
+            extra, sampler-specific diagnostics
+        """
+        self.distribution = distribution
+        self.std_error = std_error
+        self.ess = ess
+        self.samples = samples
+        self.elapsed = elapsed
+        self.extra = extra or {}
+        self.stopped = None
+
+    def half_width(self, z=1.96):
+        """
+        The largest half-width of the normal confidence intervals
+        """
+        return z * max(self.std_error)
+
+    def interval(self, z=1.96):
+        """
+        Normal confidence interval of every entry, clipped to [0, 1]
+        """
+        return [(max(0.0, p - z * s), min(1.0, p + z * s))
+                for p, s in zip(self.distribution, self.std_error)]
+
+    def as_dict(self, z=1.96):
+        """
+        The estimate as a dictionary
+        """
+        res = {
+            "distribution": self.distribution,
+            "std_error": self.std_error,
+            "interval": self.interval(z),
+            "ess": self.ess,
+            "samples": self.samples,
+            "elapsed": self.elapsed,
+            "stopped": self.stopped,
+        }
+        res.update(self.extra)
+        return res
+
+
+def rejection_stream(x, e, bn, batch_size=10000, rng=None):
+    """
+    Rejection sampling as a generator of running estimates
+    Input:
+        x, the query variable
+        e, observed values for variables E
+        bn, a Bayesian network
+        batch_size, the number of samples generated between two estimates
+        rng, a numpy Generator, SeedSequence or seed
+    Output:
+        yields an Estimate after every batch; accepted samples are independent,
+        so the standard error is the binomial one and the ESS is their number
+    """
+    rng = np.random.default_rng(rng)
+    k = bn.get_node(x).get_cardinality()
+    counts = np.zeros(k, dtype=np.int64)
+    generated = 0
+    start = time.perf_counter()
+    while True:
+        event = prior_sample_batch(bn, batch_size, e, rng)
+        generated += batch_size
+        counts += np.bincount(event[x], minlength=k)
+        accepted = int(counts.sum())
+        if accepted:
+            p = counts / accepted
+            se = np.sqrt(p * (1 - p) / accepted)
+        else:
+            p = np.full(k, np.nan)
+            se = np.full(k, np.inf)
+        yield Estimate(p.tolist(), se.tolist(), float(accepted), generated,
+                       time.perf_counter() - start,
+                       {"acceptance_rate": accepted / generated})
+
+
+def likelihood_stream(x, e, bn, batch_size=10000, rng=None, proposal=None):
+    """
+    Likelihood weighting as a generator of running estimates
+    Input:
+        x, the query variable
+        e, observed values for variables E
+        bn, a Bayesian network
+        batch_size, the number of samples generated between two estimates
+        rng, a numpy Generator, SeedSequence or seed
+        proposal, proposal CPTs (see likelihood_weighting.learn_proposal) to
+            importance sample from instead of the network's own CPTs
+    Output:
+        yields an Estimate after every batch
+
+    The ESS is Kish's (sum w)^2 / sum w^2. The standard error of the
+    self-normalized estimate p_s = W_s / W comes from the delta method,
+        var(p_s) ~ sum_i w_i^2 (1[x_i = s] - p_s)^2 / W^2,
+    which only needs the per-state sums of w and w^2; both are kept as logs.
+    """
+    rng = np.random.default_rng(rng)
+    k = bn.get_node(x).get_cardinality()
+    log_w_sum = np.full(k, -np.inf)
+    log_w2_sum = np.full(k, -np.inf)
+    generated = 0
+    start = time.perf_counter()
+    while True:
+        if proposal is None:
+            samples, log_w = weighted_sample_batch(bn, e, batch_size, rng)
+        else:
+            samples, log_w = importance_sample_batch(bn, e, batch_size, proposal, rng)
+        generated += batch_size
+        log_w_sum = np.logaddexp(log_w_sum, log_bincount(samples[x], log_w, k))
+        log_w2_sum = np.logaddexp(log_w2_sum, log_bincount(samples[x], 2 * log_w, k))
+        m = log_w_sum.max()
+        if np.isfinite(m):
+            w = np.exp(log_w_sum - m)
+            w2 = np.exp(log_w2_sum - 2 * m)
+            total = w.sum()
+            p = w / total
+            var = (w2 * (1 - p) ** 2 + (w2.sum() - w2) * p ** 2) / total ** 2
+            se = np.sqrt(var)
+            ess = float(total ** 2 / w2.sum())
+        else:
+            p = np.full(k, np.nan)
+            se = np.full(k, np.inf)
+            ess = 0.0
+        yield Estimate(p.tolist(), se.tolist(), ess, generated, time.perf_counter() - start)
+
+
+def gibbs_stream(x, e, bn, chains=4, sweeps=200, burn_in=100, rng=None):
+    """
+    Gibbs sampling as a generator of running estimates
+    Input:
+        x, the query variable
+        e, observed values for variables E
+        bn, a Bayesian network
+        chains, the number of independent chains
+        sweeps, the number of sweeps every chain runs between two estimates
+        burn_in, the number of sweeps every chain discards first
+        rng, a numpy Generator, SeedSequence or seed; the chains get
+            independent streams spawned from it
+    Output:
+        yields an Estimate after every round of sweeps
+
+    For each state, the ESS of its indicator trace is summed over the chains
+    and the standard error is sqrt(p (1 - p) / ESS). The reported ESS is the
+    smallest over the states, and R-hat is reported alongside.
+    """
+    rng = np.random.default_rng(rng)
+    k = bn.get_node(x).get_cardinality()
+    rngs = rng.spawn(chains)
+    states = [None] * chains
+    traces = [[] for c in range(chains)]
+    start = time.perf_counter()
+    while True:
+        for c in range(chains):
+            skip = burn_in if states[c] is None else 0
+            trace, states[c], rngs[c] = gibbs_chain(x, e, bn, sweeps, rngs[c], states[c], skip)
+            traces[c].extend(trace)
+        counts = np.bincount(np.concatenate(traces).astype(np.intp), minlength=k)
+        p = counts / counts.sum()
+        ess = np.array([sum(effective_sample_size(np.equal(trace, s)) for trace in traces)
+                        for s in range(k)])
+        se = np.sqrt(p * (1 - p) / ess)
+        yield Estimate(p.tolist(), se.tolist(), float(ess.min()), int(counts.sum()),
+                       time.perf_counter() - start, {"r_hat": state_r_hat(traces, k)})
+
+
+STREAMS = {
+    "rejection": rejection_stream,
+    "likelihood": likelihood_stream,
+    "gibbs": gibbs_stream,
+}
+
+
+# Default sample cap of anytime_ask, so that a query the precision rule
+# cannot stop (evidence of tiny probability) still ends
+MAX_SAMPLES = 10 ** 7
+
+
+def run_until(stream, precision=None, deadline=None, max_samples=None, min_ess=30,
+              z=1.96, callback=None, no_support=10 ** 6):
+    """
+    Consume a stream of estimates until one of the stopping rules fires
+    Input:
+        stream, a generator of Estimate objects
+        precision, stop once the largest confidence half-width is at most this
+        deadline, a wall-clock budget in seconds; the stream is also stopped
+            when the next step would probably overrun it, judged by the
+            duration of the previous step
+        max_samples, stop once this many samples were generated
+        min_ess, the precision rule only applies from this ESS on, so a few
+            agreeing samples cannot look precise
+        z, the normal quantile of the confidence intervals
+        callback, called with every estimate; returning True stops the stream
+        no_support, stop once this many samples were generated without any
+            of them supporting the evidence (no sample accepted, or zero total
+            weight), leaving the distribution NaN
+    Output:
+        the last Estimate, with stopped set to the rule that fired
+    """
+    start = time.perf_counter()
+    last = start
+    estimate = None
+    for estimate in stream:
+        now = time.perf_counter()
+        step = now - last
+        last = now
+        if callback is not None and callback(estimate):
+            estimate.stopped = "callback"
+        elif precision is not None and estimate.ess >= min_ess and \
+                estimate.half_width(z) <= precision:
+            estimate.stopped = "precision"
+        elif deadline is not None and now - start + step > deadline:
+            estimate.stopped = "deadline"
+        elif max_samples is not None and estimate.samples >= max_samples:
+            estimate.stopped = "max_samples"
+        elif no_support is not None and estimate.samples >= no_support and \
+                all(math.isnan(p) for p in estimate.distribution):
+            estimate.stopped = "no_support"
+        else:
+            continue
+        break
+    stream.close()
+    return estimate
+
+
+def anytime_ask(x, e, bn, algorithm="likelihood", precision=0.01, deadline=None,
+                max_samples=MAX_SAMPLES, rng=None, **kwargs):
+    """
+    Estimate P(X|e) to a target precision or within a time budget
+    Input:
+        x, the query variable
+        e, observed values for variables E
+        bn, a Bayesian network
+        algorithm, a name in STREAMS
+        precision, the target half-width of the 95% confidence intervals
+        deadline, the wall-clock budget in seconds
+        max_samples, the largest number of samples to generate (None for no
+            cap, which may never stop if the ESS stays below 30)
+        rng, a numpy Generator, SeedSequence or seed
+        kwargs, passed on to the stream (batch_size, chains, sweeps, ...)
+    Output:
+        an Estimate
+    """
+    stream = STREAMS[algorithm](x, e, bn, rng=rng, **kwargs)
+    return run_until(stream, precision, deadline, max_samples)
+
+
+def main():
+    """
+    Anytime sampling main function
+    Usage: anytime.py algorithm precision deadline file_name x [evidence ...]
+    """
+    algorithm = sys.argv[1]
+    precision = float(sys.argv[2])
+    deadline = float(sys.argv[3])
+    file_name = sys.argv[4]
+    x = sys.argv[5]
+    bn = BayesianNetwork.load_network(file_name, "BayesianNet")
+    e = BayesianNetwork.parse_evidence(bn, sys.argv[6:])
+    print(anytime_ask(x, e, bn, algorithm, precision, deadline).as_dict())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+import BayesianNetwork
+import elimination_order
+import numpy as np
+from exact_inferencer import normalize
+import sys
+
+
+class ArithmeticCircuit(object):
+    """
+    Class of arithmetic circuit: the network polynomial of a Bayesian network,
+    compiled once and evaluated for any evidence.
+
+    Nodes are numbered so that every node comes after its children: first one
+    evidence indicator per (variable, state), then one parameter per CPT
+    entry, then the internal nodes. Internal nodes are created in blocks by
+    variable elimination (one block per factor product or summation), and a
+    block is stored as arrays of child ids, so both passes are a short loop
+    over blocks with every block evaluated as a single vectorized operation
+    across the whole batch of evidence vectors.
+
+    Values are not rescaled, so P(e) may underflow for very long evidence
+    sets on large networks.
+    """
+    def __init__(self, bn, heuristic="min-fill"):
+        """
+        Compile the network
+        """
+        self.bn = bn
+        self.variables = [node.get_name() for node in bn.get_nodelist()]
+        self.cards = [node.get_cardinality() for node in bn.get_nodelist()]
+        self.size = 0
+        self.steps = []
+
+        self.indicators = {}
+        for var, k in zip(self.variables, self.cards):
+            self.indicators[var] = self.new_nodes(k)
+        self.num_indicators = self.size
+        cpts = []
+        for node in bn.get_nodelist():
+            ids = self.new_nodes(node.cpt.size)
+            ids = np.moveaxis(ids.reshape(tuple(node.parent_cards) + (node.get_cardinality(),)), -1, 0)
+            cpts.append(([node.get_name()] + list(node.get_parent()), ids))
+        self.params = np.concatenate([node.cpt.ravel() for node in bn.get_nodelist()])
+        # Every CPT factor is multiplied by the indicators of its own variable
+        factors = [self.product(cpt, ([var], self.indicators[var]))
+                   for cpt, var in zip(cpts, self.variables)]
+
+        order, self.width = elimination_order.elimination_order(bn, heuristic=heuristic)
+        for var in order:
+            bucket = [f for f in factors if var in f[0]]
+            factors = [f for f in factors if var not in f[0]]
+            f = bucket[0]
+            for g in bucket[1:]:
+                f = self.product(f, g)
+            factors.append(self.sum_out(var, f))
+        root = factors[0]
+        for f in factors[1:]:
+            root = self.product(root, f)
+        self.root = int(root[1])
+
+    def new_nodes(self, count):
+        """
+        Allocate count consecutive node ids
+        """
+        ids = np.arange(self.size, self.size + count, dtype=np.int64)
+        self.size += count
+        return ids
+
+    def product(self, f1, f2):
+        """
+        Add one product node per entry of the product of two factors, each
+        factor being a (variables, array of node ids) pair
+        """
+        variables = list(f1[0]) + [v for v in f2[0] if v not in f1[0]]
+        a, b = np.broadcast_arrays(align(f1, variables), align(f2, variables))
+        shape = a.shape
+        ids = self.new_nodes(a.size)
+        a = a.ravel()
+        b = b.ravel()
+        self.steps.append(("product", ids[0], ids[-1] + 1, a, b, grouping(a), grouping(b)))
+        return variables, ids.reshape(shape)
+
+    def sum_out(self, var, f):
+        """
+        Add one sum node per entry of the factor with var summed out
+        """
+        axis = f[0].index(var)
+        variables = [v for v in f[0] if v != var]
+        children = np.moveaxis(f[1], axis, -1)
+        shape = children.shape[:-1]
+        children = children.reshape(-1, children.shape[-1])
+        ids = self.new_nodes(len(children))
+        self.steps.append(("sum", ids[0], ids[-1] + 1, children))
+        return variables, ids.reshape(shape)
+
+    def evidence_array(self, evidence):
+        """
+        Input:
+            a list of evidence dictionaries
+        Output:
+            an int array with one row per evidence dictionary and one column
+            per variable (in node list order), holding the observed state
+            index or -1
+        """
+        res = np.full((len(evidence), len(self.variables)), -1, dtype=np.int64)
+        for i, e in enumerate(evidence):
+            for var, state in self.bn.evidence_states(e).items():
+                res[i, self.bn.get_id(var)] = state
+        return res
+
+    def indicator_values(self, evidence):
+        """
+        The value of every indicator for a batch of evidence: 1 if the
+        variable is unobserved or observed in that state, 0 otherwise
+        """
+        res = np.empty((self.num_indicators, len(evidence)))
+        for j, var in enumerate(self.variables):
+            states = np.arange(self.cards[j])[:, None]
+            observed = evidence[:, j]
+            res[self.indicators[var]] = (observed < 0) | (observed == states)
+        return res
+
+    def upward(self, evidence):
+        """
+        Evaluate every node of the circuit
+        Input:
+            an evidence array (see evidence_array)
+        Output:
+            an array of shape (size, batch) holding the value of every node;
+            the row of the root holds P(e)
+        """
+        values = np.empty((self.size, len(evidence)))
+        values[:self.num_indicators] = self.indicator_values(evidence)
+        values[self.num_indicators: self.num_indicators + len(self.params)] = self.params[:, None]
+        for step in self.steps:
+            if step[0] == "product":
+                values[step[1]: step[2]] = values[step[3]] * values[step[4]]
+            else:
+                values[step[1]: step[2]] = values[step[3]].sum(axis=1)
+        return values
+
+    def downward(self, values):
+        """
+        Differentiate the root with respect to every node
+        Input:
+            the output of upward
+        Output:
+            an array of the same shape holding the partial derivatives
+        """
+        derivatives = np.zeros_like(values)
+        derivatives[self.root] = 1.0
+        for step in reversed(self.steps):
+            d = derivatives[step[1]: step[2]]
+            if step[0] == "product":
+                for child, other, group in ((step[3], step[4], step[5]), (step[4], step[3], step[6])):
+                    contribution = d * values[other]
+                    if group is None:
+                        derivatives[child] += contribution
+                    else:
+                        order, starts, unique = group
+                        derivatives[unique] += np.add.reduceat(contribution[order], starts, axis=0)
+            else:
+                # The children of the sum nodes of one block are all distinct
+                derivatives[step[3]] += d[:, None, :]
+        return derivatives
+
+    def evaluate(self, evidence, batch_size=1024):
+        """
+        P(e) and every posterior marginal for a batch of evidence
+        Input:
+            evidence, a list of evidence dictionaries or an evidence array
+            batch_size, the number of evidence vectors evaluated together
+        Output:
+            probability, an array holding P(e) for every evidence vector
+            marginals, a dictionary mapping each variable to an array of shape
+                (batch, cardinality) holding P(X|e) (NaN where P(e) = 0)
+        """
+        if not isinstance(evidence, np.ndarray):
+            evidence = self.evidence_array(evidence)
+        probability = np.empty(len(evidence))
+        marginals = {}
+        for var, k in zip(self.variables, self.cards):
+            marginals[var] = np.empty((len(evidence), k))
+        for start in range(0, len(evidence), batch_size):
+            chunk = evidence[start: start + batch_size]
+            values = self.upward(chunk)
+            derivatives = self.downward(values)
+            p_e = values[self.root]
+            probability[start: start + len(chunk)] = p_e
+            with np.errstate(divide="ignore", invalid="ignore"):
+                for j, var in enumerate(self.variables):
+                    # The derivative with respect to the indicator of X = x is
+                    # P(X = x, e) when X is unobserved
+                    joint = derivatives[self.indicators[var]].T / p_e[:, None]
+                    observed = chunk[:, j] >= 0
+                    joint[observed] = np.eye(self.cards[j])[chunk[observed, j]]
+                    joint[p_e == 0] = np.nan
+                    marginals[var][start: start + len(chunk)] = joint
+        return probability, marginals
+
+    def probability_of_evidence(self, e):
+        """
+        P(e) for one evidence dictionary
+        """
+        return float(self.upward(self.evidence_array([e]))[self.root, 0])
+
+    def query(self, x, e):
+        """
+        Input:
+            x, the query variable
+            e, observed values for variables E
+        Output:
+            a distribution over X
+        """
+        probability, marginals = self.evaluate([e])
+        return normalize(marginals[x][0].tolist())
+
+
+def align(f, variables):
+    """
+    The node ids of a (variables, ids) factor transposed into the given
+    variable order, with a length-1 axis for every variable it does not
+    mention (as Factor.expand)
+    """
+    present = [v for v in variables if v in f[0]]
+    ids = np.transpose(f[1], [f[0].index(v) for v in present])
+    shape = [f[1].shape[f[0].index(v)] if v in f[0] else 1 for v in variables]
+    return ids.reshape(shape)
+
+
+def grouping(children):
+    """
+    Precompute how to add the contributions of many parents into children
+    that repeat: the order sorting the children, the start of every run of
+    equal children in that order, and the distinct children (None when no
+    child repeats, so the contributions can be added directly)
+    """
+    order = np.argsort(children, kind="stable")
+    ordered = children[order]
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    if len(starts) == len(children):
+        return None
+    return order, starts, ordered[starts]
+
+
+def main():
+    """
+    Arithmetic circuit main function
+    """
+    file_name = sys.argv[1]
+    bn = BayesianNetwork.load_network(file_name, "BayesianNet")
+    x = sys.argv[2]
+    e = BayesianNetwork.parse_evidence(bn, sys.argv[3:])
+    print(ArithmeticCircuit(bn).query(x, e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import BayesianNetwork
+import elimination_order
+from exact_inferencer import normalize
+from variable_elimination import point_wise_product, sum_out
+import sys
+
+
+def product(factors):
+    """
+    Point-wise product of a list of factors
+    """
+    res = BayesianNetwork.Factor()
+    for f in factors:
+        res = point_wise_product(res, f)
+    return res
+
+
+def project(f, variables):
+    """
+    Sum out every variable of f that is not in variables
+    """
+    for var in list(f.variables):
+        if var not in variables:
+            f = sum_out(var, f)
+    return f
+
+
+def all_marginals(bn, e, variables=None, heuristic="min-fill"):
+    """
+    Compute many posterior marginals with one shared elimination
+    Input:
+        bn, a Bayesian network
+        e, observed values for variables E
+        variables, the query variables (default: every variable in bn)
+        heuristic, the elimination ordering heuristic
+    Output:
+        a dictionary mapping each query variable to its distribution given e
+
+    The factors are built once and arranged in a bucket tree along an
+    elimination order of all unobserved variables. An upward pass sends the
+    usual elimination messages, and a downward pass sends the complementary
+    ones; each message is computed once and cached, so every marginal is read
+    off its own bucket instead of repeating the elimination per query.
+    """
+    if variables is None:
+        variables = [node.get_name() for node in bn.get_nodelist()]
+    e = bn.evidence_states(e)
+    factors = []
+    for node in bn.get_nodelist():
+        f = BayesianNetwork.make_factor(node, e)
+        if f.variables:
+            factors.append(f)
+    order = elimination_order.elimination_order(bn, e, heuristic=heuristic)[0]
+    position = {}
+    for i, var in enumerate(order):
+        position[var] = i
+
+    # Each factor goes to the bucket of its earliest eliminated variable
+    buckets = [[] for var in order]
+    for f in factors:
+        buckets[min(position[v] for v in f.variables)].append(f)
+
+    # Upward pass: bucket i sends its message to the bucket of the earliest
+    # eliminated variable left in the message
+    up = {}
+    parent = {}
+    children = [[] for var in order]
+    for i, var in enumerate(order):
+        incoming = [up[c] for c in children[i]]
+        up[i] = sum_out(var, product(buckets[i] + incoming))
+        if up[i].variables:
+            parent[i] = min(position[v] for v in up[i].variables)
+            children[parent[i]].append(i)
+
+    # Downward pass: from the roots towards the leaves
+    down = {}
+    for i in range(len(order) - 1, -1, -1):
+        if i not in parent:
+            continue
+        p = parent[i]
+        incoming = [up[c] for c in children[p] if c != i]
+        if p in down:
+            incoming.append(down[p])
+        down[i] = project(product(buckets[p] + incoming), up[i].variables)
+
+    res = {}
+    for x in variables:
+        if x in e:
+            res[x] = [0.0] * bn.get_node(x).get_cardinality()
+            res[x][e[x]] = 1.0
+            continue
+        i = position[x]
+        incoming = [up[c] for c in children[i]]
+        if i in down:
+            incoming.append(down[i])
+        marginal = project(product(buckets[i] + incoming), [x])
+        res[x] = normalize([float(v) for v in marginal.values])
+    return res
+
+
+def batch_query(bn, queries, heuristic="min-fill"):
+    """
+    Answer many (query variable, evidence) pairs at once
+    Input:
+        bn, a Bayesian network
+        queries, a list of (x, e) pairs
+        heuristic, the elimination ordering heuristic
+    Output:
+        a list holding the distribution over x given e for each query, in order
+
+    Queries sharing the same evidence are answered by a single call to
+    all_marginals.
+    """
+    groups = {}
+    for x, e in queries:
+        key = frozenset(e.items())
+        groups.setdefault(key, set()).add(x)
+    answers = {}
+    for key, variables in groups.items():
+        answers[key] = all_marginals(bn, dict(key), list(variables), heuristic)
+    return [answers[frozenset(e.items())][x] for x, e in queries]
+
+
+def main():
+    """
+    Batch inference main function
+    """
+    file_name = sys.argv[1]
+    bn = BayesianNetwork.load_network(file_name, "BayesianNet")
+    x = sys.argv[2].split(',')
+    e = BayesianNetwork.parse_evidence(bn, sys.argv[3:])
+    res = all_marginals(bn, e, x)
+    for var in x:
+        print(var, res[var])
+
+
+if __name__ == '__main__':
+    main()
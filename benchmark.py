@@ -0,0 +1,313 @@
+"""
+Benchmark suite: generate synthetic networks of controlled size, in-degree,
+treewidth and CPT skew, write them as XMLBIF, and time every inference
+engine on them.
+
+Usage:
+    benchmark.py output.json [samples] [network-directory]
+    benchmark.py --compare old.json new.json
+"""
+import BayesianNetwork
+import elimination_order
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from xml.sax.saxutils import escape
+from exact_inferencer import enumerate_ask
+from gibbs_sampling import gibbs_ask
+from likelihood_weighting import likelihood_weighting
+from rejection_sampling import rejection_sampling
+from variable_elimination import elimination_ask
+
+
+def polytree(n, in_degree, rng):
+    """
+    A random polytree: every node gets up to in_degree parents, taken from
+    different components of the graph built so far, so no undirected cycle
+    is ever closed
+    Output:
+        a list of (name, parent names) in topological order
+    """
+    component = list(range(n))
+
+    def find(i):
+        while component[i] != i:
+            component[i] = component[component[i]]
+            i = component[i]
+        return i
+
+    structure = []
+    for i in range(n):
+        parents = []
+        for j in rng.permutation(i):
+            if len(parents) == in_degree:
+                break
+            if find(j) != find(i):
+                component[find(j)] = find(i)
+                parents.append("X%d" % j)
+        structure.append(("X%d" % i, parents))
+    return structure
+
+
+def grid(rows, cols):
+    """
+    A rows x cols grid, every cell having its left and upper neighbours as
+    parents; its treewidth is min(rows, cols)
+    """
+    structure = []
+    for r in range(rows):
+        for c in range(cols):
+            parents = []
+            if c > 0:
+                parents.append("X%d_%d" % (r, c - 1))
+            if r > 0:
+                parents.append("X%d_%d" % (r - 1, c))
+            structure.append(("X%d_%d" % (r, c), parents))
+    return structure
+
+
+def layered(layers, width, in_degree, rng):
+    """
+    Layers of width nodes, every node taking in_degree random parents from
+    the layer above
+    """
+    structure = []
+    for l in range(layers):
+        for i in range(width):
+            parents = []
+            if l > 0:
+                for j in sorted(rng.choice(width, min(in_degree, width), replace=False)):
+                    parents.append("X%d_%d" % (l - 1, j))
+            structure.append(("X%d_%d" % (l, i), parents))
+    return structure
+
+
+def random_cpts(structure, rng, skew=1.0, cardinality=2):
+    """
+    Draw every CPT row from a symmetric Dirichlet distribution
+    Input:
+        structure, a list of (name, parent names) in topological order
+        rng, a numpy random Generator
+        skew, the Dirichlet concentration: 1 is uniform over distributions,
+            smaller values give near-deterministic rows
+        cardinality, the number of states of every variable
+    Output:
+        a dictionary mapping each variable to its (rows, cardinality) table
+    """
+    tables = {}
+    for name, parents in structure:
+        rows = cardinality ** len(parents)
+        tables[name] = rng.dirichlet([skew] * cardinality, size=rows)
+    return tables
+
+
+def write_xmlbif(filename, name, structure, tables):
+    """
+    Write a network in the XMLBIF 0.3 format read by xml_reader
+    """
+    with open(filename, "w") as f:
+        f.write('<?xml version="1.0" encoding="US-ASCII"?>\n')
+        f.write('<BIF VERSION="0.3">\n<NETWORK>\n<NAME>%s</NAME>\n\n' % escape(name))
+        for var, parents in structure:
+            k = tables[var].shape[1]
+            f.write('<VARIABLE TYPE="nature">\n\t<NAME>%s</NAME>\n' % escape(var))
+            if k == 2:
+                f.write('\t<OUTCOME>true</OUTCOME>\n\t<OUTCOME>false</OUTCOME>\n')
+            else:
+                for j in range(k):
+                    f.write('\t<OUTCOME>s%d</OUTCOME>\n' % j)
+            f.write('</VARIABLE>\n\n')
+        for var, parents in structure:
+            f.write('<DEFINITION>\n\t<FOR>%s</FOR>\n' % escape(var))
+            for p in parents:
+                f.write('\t<GIVEN>%s</GIVEN>\n' % escape(p))
+            f.write('\t<TABLE>%s</TABLE>\n</DEFINITION>\n\n' %
+                    ' '.join(repr(float(v)) for v in tables[var].ravel()))
+        f.write('</NETWORK>\n</BIF>\n')
+
+
+def random_query(bn, rng, evidence=3):
+    """
+    Query the last node in topological order given random observations of
+    up to evidence other nodes
+    """
+    names = [node.get_name() for node in bn.get_sorted_nodelist()]
+    x = names[-1]
+    e = {}
+    for i in rng.permutation(len(names) - 1)[:evidence]:
+        node = bn.get_node(names[i])
+        e[names[i]] = node.state_value(int(rng.integers(node.get_cardinality())))
+    return x, e
+
+
+def suite(rng):
+    """
+    The default benchmark networks: (family, parameters, structure, skew)
+    """
+    res = []
+    for n in (20, 50, 100):
+        res.append(("polytree", {"nodes": n, "in_degree": 3}, polytree(n, 3, rng), 1.0))
+    for side in (3, 4, 5):
+        res.append(("grid", {"rows": side, "cols": side}, grid(side, side), 1.0))
+    for in_degree in (2, 3):
+        res.append(("layered", {"layers": 4, "width": 5, "in_degree": in_degree},
+                    layered(4, 5, in_degree, rng), 1.0))
+    res.append(("layered", {"layers": 4, "width": 5, "in_degree": 2},
+                layered(4, 5, 2, rng), 0.2))
+    return res
+
+
+ENGINES = [
+    ("enumeration", False),
+    ("elimination", False),
+    ("rejection", True),
+    ("likelihood", True),
+    ("gibbs", True),
+]
+
+
+def run_engine(engine, x, e, bn, n, seed=None):
+    """
+    Run one engine on one query; the samplers are seeded with seed
+    """
+    if engine == "enumeration":
+        return enumerate_ask(x, e, bn)
+    if engine == "elimination":
+        return elimination_ask(x, e, bn)
+    if engine == "rejection":
+        return rejection_sampling(x, e, bn, n, rng=seed)
+    if engine == "likelihood":
+        return likelihood_weighting(x, e, bn, n, rng=seed)
+    return gibbs_ask(x, e, bn, n, rng=seed)
+
+
+def measure(engine, x, e, bn, n, memory=True, seed=None):
+    """
+    Time one engine, then run it again under tracemalloc for its peak memory
+    (tracing slows Python code down, so the two are measured separately)
+    Output:
+        (distribution, wall time in seconds, peak memory in KiB or None)
+    """
+    start = time.perf_counter()
+    dist = run_engine(engine, x, e, bn, n, seed)
+    wall = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        run_engine(engine, x, e, bn, n, seed)
+        peak = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+    return dist, wall, peak
+
+
+def benchmark(n=10000, directory=None, seed=0, max_enumeration_nodes=20, memory=True):
+    """
+    Run every engine on every network of the suite
+    Input:
+        n, the number of samples for the sampling engines
+        directory, where the XMLBIF files are written, created if needed
+            (default: a temporary directory)
+        seed, the seed of the network and query generators and of the samplers
+        max_enumeration_nodes, enumeration is skipped on larger networks
+        memory, whether to measure the peak memory
+    Output:
+        a list of result records
+    """
+    rng = np.random.default_rng(seed)
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="bnbench")
+    os.makedirs(directory, exist_ok=True)
+    results = []
+    for family, params, structure, skew in suite(rng):
+        name = "%s-%s-skew%g" % (family, "-".join("%s%d" % item for item in params.items()), skew)
+        filename = os.path.join(directory, name + ".xml")
+        write_xmlbif(filename, name, structure, random_cpts(structure, rng, skew))
+        bn = BayesianNetwork.xml_reader(filename, name)
+        x, e = random_query(bn, rng)
+        width = elimination_order.elimination_order(bn, bn.evidence_states(e))[1]
+        exact = elimination_ask(x, e, bn)
+        for engine, sampling in ENGINES:
+            record = {
+                "network": name,
+                "family": family,
+                "params": params,
+                "skew": skew,
+                "nodes": len(structure),
+                "edges": sum(len(parents) for var, parents in structure),
+                "width": width,
+                "query": x,
+                "evidence": dict((k, str(v)) for k, v in e.items()),
+                "engine": engine,
+                "n": n if sampling else None,
+            }
+            if engine == "enumeration" and len(structure) > max_enumeration_nodes:
+                record["skipped"] = "more than %d nodes" % max_enumeration_nodes
+                results.append(record)
+                continue
+            dist, wall, peak = measure(engine, x, e, bn, n, memory, seed)
+            record["wall_s"] = wall
+            record["peak_kib"] = peak
+            record["samples_per_s"] = n / wall if sampling else None
+            if any(v != v for v in dist):
+                record["error"] = None
+            else:
+                record["error"] = max(abs(a - b) for a, b in zip(dist, exact))
+            results.append(record)
+            print("%-40s %-12s %9.4fs  error %s" % (name, engine, wall, record["error"]))
+    return results
+
+
+def save(results, filename):
+    """
+    Save results with enough context to compare runs
+    """
+    with open(filename, "w") as f:
+        json.dump({
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "results": results,
+        }, f, indent=1)
+
+
+def compare(old_file, new_file, threshold=1.2):
+    """
+    Print the (network, engine) pairs whose wall time grew by more than
+    threshold between two saved runs
+    Output:
+        the list of regressions as (network, engine, old time, new time)
+    """
+    runs = []
+    for filename in (old_file, new_file):
+        with open(filename) as f:
+            runs.append(dict(((r["network"], r["engine"]), r) for r in json.load(f)["results"]
+                             if "wall_s" in r))
+    regressions = []
+    for key in sorted(runs[1]):
+        if key in runs[0] and runs[1][key]["wall_s"] > threshold * runs[0][key]["wall_s"]:
+            regressions.append(key + (runs[0][key]["wall_s"], runs[1][key]["wall_s"]))
+    for network, engine, old, new in regressions:
+        print("%-40s %-12s %9.4fs -> %9.4fs" % (network, engine, old, new))
+    return regressions
+
+
+def main():
+    """
+    Benchmark main function
+    """
+    if sys.argv[1] == "--compare":
+        compare(sys.argv[2], sys.argv[3])
+        return
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    directory = sys.argv[3] if len(sys.argv) > 3 else None
+    save(benchmark(n, directory), sys.argv[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import heapq
+
+
+def interaction_graph(bn, e={}):
+    """
+    Build the moral graph of a Bayesian network restricted to unobserved variables
+    Input:
+        bn, a Bayesian network
+        e, observed values for variables E (observed variables are left out)
+    Output:
+        a dictionary mapping every unobserved variable to the set of its neighbours
+    """
+    graph = {}
+    for node in bn.get_nodelist():
+        family = [node.get_name()] + list(node.get_parent())
+        family = [v for v in family if v not in e]
+        for v in family:
+            graph.setdefault(v, set())
+        for v in family:
+            for u in family:
+                if u != v:
+                    graph[v].add(u)
+    return graph
+
+
+def min_degree(graph, var, cardinality):
+    """
+    Cost of eliminating var: the number of its neighbours
+    """
+    return len(graph[var])
+
+
+def min_fill(graph, var, cardinality):
+    """
+    Cost of eliminating var: the number of edges that eliminating it adds
+    """
+    neighbours = list(graph[var])
+    fill = 0
+    for i in range(len(neighbours)):
+        for j in range(i + 1, len(neighbours)):
+            if neighbours[j] not in graph[neighbours[i]]:
+                fill += 1
+    return fill
+
+
+def min_weight(graph, var, cardinality):
+    """
+    Cost of eliminating var: the number of entries of the factor it creates
+    """
+    weight = cardinality.get(var, 2)
+    for u in graph[var]:
+        weight *= cardinality.get(u, 2)
+    return weight
+
+
+HEURISTICS = {
+    "min-degree": min_degree,
+    "min-fill": min_fill,
+    "min-weight": min_weight,
+}
+
+# The heuristics whose cost only depends on the neighbours of var, not on the
+# edges between them
+NEIGHBOURHOOD_COSTS = (min_degree, min_weight)
+
+
+def elimination_order(bn, e={}, variables=None, heuristic="min-fill"):
+    """
+    Greedy elimination ordering
+    Input:
+        bn, a Bayesian network
+        e, observed values for variables E
+        variables, the variables to eliminate (default: every unobserved variable)
+        heuristic, a name in HEURISTICS or a function (graph, var, cardinality) -> cost
+    Output:
+        order, the variables in the order they should be eliminated
+        width, the induced width of the order (size of the largest factor
+            created during elimination, minus one)
+
+    The costs are kept in a heap and, after each elimination, only the costs
+    that can have changed are recomputed: those of the neighbours of the
+    eliminated variable, and for min-fill (or a custom heuristic, whose cost
+    may depend on the edges around var) those of their neighbours as well.
+    """
+    cost = HEURISTICS[heuristic] if isinstance(heuristic, str) else heuristic
+    graph = interaction_graph(bn, e)
+    cardinality = {}
+    for node in bn.get_nodelist():
+        cardinality[node.get_name()] = node.get_cardinality()
+    if variables is None:
+        variables = list(graph)
+    # Ties are broken by position in the node list, so the order is deterministic
+    rank = {}
+    for i, v in enumerate(variables):
+        rank[v] = i
+    remaining = set(v for v in variables if v in graph)
+    costs = {}
+    heap = []
+    for v in remaining:
+        costs[v] = cost(graph, v, cardinality)
+        heap.append((costs[v], rank[v], v))
+    heapq.heapify(heap)
+    order = []
+    width = 0
+    while heap:
+        c, r, var = heapq.heappop(heap)
+        # Entries of eliminated variables and outdated costs are skipped
+        if var not in remaining or costs[var] != c:
+            continue
+        neighbours = graph.pop(var)
+        width = max(width, len(neighbours))
+        for u in neighbours:
+            graph[u].discard(var)
+            graph[u].update(w for w in neighbours if w != u)
+        remaining.discard(var)
+        order.append(var)
+        changed = set(neighbours)
+        if cost not in NEIGHBOURHOOD_COSTS:
+            for u in neighbours:
+                changed.update(graph[u])
+        for u in changed & remaining:
+            c = cost(graph, u, cardinality)
+            if c != costs[u]:
+                costs[u] = c
+                heapq.heappush(heap, (c, rank[u], u))
+    return order, width
+
+
+def elimination_cliques(bn, order, e={}):
+    """
+    Triangulate the moral graph by eliminating variables in the given order
+    Input:
+        bn, a Bayesian network
+        order, an elimination order of every unobserved variable
+        e, observed values for variables E
+    Output:
+        the maximal cliques of the triangulated graph, as a list of sets
+    """
+    graph = interaction_graph(bn, e)
+    cliques = []
+    for var in order:
+        neighbours = graph.pop(var)
+        for u in neighbours:
+            graph[u].discard(var)
+            graph[u].update(w for w in neighbours if w != u)
+        clique = set(neighbours)
+        clique.add(var)
+        # A clique created later never contains var, so it can only be a
+        # subset of an earlier one
+        if not any(clique <= c for c in cliques):
+            cliques.append(clique)
+    return cliques
@@ -1,37 +1,64 @@
 import BayesianNetwork
+import instrumentation
+from collections import OrderedDict
+import math
+import time
+import warnings
 import sys
 
 
-def enumerate_ask(x, e, bn):
+@instrumentation.instrumented("enumeration")
+def enumerate_ask(x, e, bn, cache=None, log=False):
     """
     Input:
         x, the query variable
         e, observed values for variables E
         bn, a Bayes net with variables {X} ∪ E ∪ Y
+        cache, an LRUCache to memoize sub-results in (optional, one per network)
+        log, whether to enumerate in the log domain, which cannot underflow
     Output:
         a distribution over X
     """
+    record = instrumentation.active()
+    if record is not None:
+        t = time.perf_counter()
     q = []
     bn_vars = []
-    node_list = bn.get_nodelist()
+    node_list = bn.get_sorted_nodelist()
     for node in node_list:
         bn_vars.append(node.get_name())
-    e[x] = True
-    q.append(enumerate_all(bn_vars, e, bn))
-    e[x] = False
-    q.append(enumerate_all(bn_vars, e, bn))
-    return normalize(q)
+    e = bn.evidence_states(e)
+    states = range(bn.get_node(x).get_cardinality())
+    if cache is None:
+        for value in states:
+            e[x] = value
+            q.append(enumerate_all(bn_vars, e, bn, log))
+    else:
+        frontier = enumeration_frontier(bn)
+        hits, misses = cache.hits, cache.misses
+        for value in states:
+            e[x] = value
+            q.append(enumerate_all_memo(0, bn_vars, frontier, e, bn, cache, log))
+        if record is not None:
+            record.count("cache_hits", cache.hits - hits)
+            record.count("cache_misses", cache.misses - misses)
+    if record is not None:
+        instrumentation.lap(record, "enumeration", t)
+    return normalize(q, log)
 
 
-def enumerate_all(bn_vars, e, bn):
+def enumerate_all(bn_vars, e, bn, log=False):
     """
     Enumerate all possible assignment
     Input:
         bn_vars, a list of all variables in Bayes net
         e, observed values
+        log, whether to work with log-probabilities
     Output:
-        a real number
+        a real number (its logarithm if log is set)
     """
+    if log:
+        return enumerate_all_log(bn_vars, e, bn)
     if not bn_vars:
         return 1.0
     y = bn_vars[0]
@@ -47,39 +74,198 @@ def enumerate_all(bn_vars, e, bn):
         return node.get_probability(e[y], p) * enumerate_all(tmp, e_copy, bn)
     else:
         e_copy = e.copy()
-        e_copy[y] = True
-        first = node.get_probability(True, p) * enumerate_all(tmp, e_copy, bn)
-        e_copy[y] = False
-        second = node.get_probability(False, p) * enumerate_all(tmp, e_copy, bn)
-        return first + second
+        total = 0.0
+        for value in range(node.get_cardinality()):
+            e_copy[y] = value
+            total += node.get_probability(value, p) * enumerate_all(tmp, e_copy, bn)
+        return total
 
 
-def normalize(distribution=[]):
+def enumerate_all_log(bn_vars, e, bn):
     """
-    Normalization function
+    Log-domain version of enumerate_all: products become sums of
+    log-probabilities and sums become log-sum-exp
+    """
+    if not bn_vars:
+        return 0.0
+    y = bn_vars[0]
+    tmp = bn_vars[1:]
+    node = bn.get_node(y)
+    p = [e[item] for item in node.get_parent()]
+    if y in e:
+        return log_probability(node, e[y], p) + enumerate_all_log(tmp, e.copy(), bn)
+    e_copy = e.copy()
+    terms = []
+    for value in range(node.get_cardinality()):
+        e_copy[y] = value
+        terms.append(log_probability(node, value, p) + enumerate_all_log(tmp, e_copy, bn))
+    return log_sum_exp(terms)
+
+
+def log_probability(node, value, parents):
+    """
+    log P(node = value | parents), -inf for an impossible value
+    """
+    prob = node.get_probability(value, parents)
+    return math.log(prob) if prob > 0 else -math.inf
+
+
+def log_sum_exp(terms):
+    """
+    log(sum(exp(t) for t in terms)), computed without underflow
+    """
+    m = max(terms)
+    if m == -math.inf:
+        return m
+    return m + math.log(sum(math.exp(t - m) for t in terms))
+
+
+def enumeration_frontier(bn):
     """
-    res = []
-    total = 0
-    for item in distribution:
-        total += item
-    if total == 0:
-        return "We don't have enough samples"
-    for item in distribution:
-        res.append(round(item/total, 3))
+    Input:
+        bn, a Bayesian network
+    Output:
+        a list whose i-th entry holds the variables among the first i nodes
+        that a node at position i or later depends on; the sum over the
+        remaining nodes is a function of their values only
+    """
+    node_list = bn.get_sorted_nodelist()
+    frontier = []
+    for i in range(len(node_list)):
+        earlier = set(node.get_name() for node in node_list[:i])
+        needed = set()
+        for node in node_list[i:]:
+            needed.update(p for p in node.get_parent() if p in earlier)
+        frontier.append(sorted(needed))
+    return frontier
+
+
+def enumerate_all_memo(i, bn_vars, frontier, e, bn, cache, log=False):
+    """
+    Memoized version of enumerate_all over bn_vars[i:]
+    Input:
+        i, the index of the first remaining variable
+        bn_vars, a list of all variables in Bayes net
+        frontier, the output of enumeration_frontier(bn)
+        e, observed values (assigned variables are set in place and restored)
+        cache, an LRUCache
+        log, whether to work with log-probabilities
+    Output:
+        a real number (its logarithm if log is set)
+    """
+    if i == len(bn_vars):
+        return 0.0 if log else 1.0
+    key = (i,
+           tuple(e[v] for v in frontier[i]),
+           tuple((v, e[v]) for v in bn_vars[i:] if v in e),
+           log)
+    res = cache.get(key)
+    if res is not None:
+        return res
+    y = bn_vars[i]
+    node = bn.get_node(y)
+    p = [e[item] for item in node.get_parent()]
+    observed = y in e
+    values = [e[y]] if observed else range(node.get_cardinality())
+    terms = []
+    for value in values:
+        e[y] = value
+        rest = enumerate_all_memo(i + 1, bn_vars, frontier, e, bn, cache, log)
+        if log:
+            terms.append(log_probability(node, value, p) + rest)
+        else:
+            terms.append(node.get_probability(value, p) * rest)
+    if not observed:
+        del e[y]
+    res = log_sum_exp(terms) if log else sum(terms)
+    cache.put(key, res)
     return res
 
 
+class LRUCache(object):
+    """
+    Class of bounded least-recently-used cache with hit/miss statistics
+    """
+    def __init__(self, maxsize=100000):
+        """
+        Initialization
+        """
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Get the value stored for key, or None if it is not cached
+        """
+        if key in self.table:
+            self.table.move_to_end(key)
+            self.hits += 1
+            return self.table[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Store value for key, evicting the least recently used entry when full
+        """
+        self.table[key] = value
+        self.table.move_to_end(key)
+        if len(self.table) > self.maxsize:
+            self.table.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop every entry and reset the statistics
+        """
+        self.table.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        Get the cache statistics
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self.table), "maxsize": self.maxsize}
+
+
+def normalize(distribution=[], log=False):
+    """
+    Normalization function
+    Input:
+        distribution, unnormalized weights (log-weights if log is set)
+    Output:
+        the normalized distribution as a list, rounded to 3 decimals. The
+        weights are scaled by their maximum first, so tiny or huge totals do
+        not underflow or overflow. When every weight is zero (the evidence is
+        impossible, or no sample agreed with it) a list of NaN is returned.
+    """
+    distribution = [float(item) for item in distribution]
+    if log:
+        m = max(distribution) if distribution else -math.inf
+        if m == -math.inf or math.isnan(m):
+            warnings.warn("We don't have enough samples")
+            return [math.nan] * len(distribution)
+        distribution = [math.exp(item - m) for item in distribution]
+    m = max(distribution) if distribution else 0.0
+    if not m > 0:
+        warnings.warn("We don't have enough samples")
+        return [math.nan] * len(distribution)
+    scaled = [item / m for item in distribution]
+    total = sum(scaled)
+    return [round(item / total, 3) for item in scaled]
+
+
 def main():
     """
     Exact inference main function
     """
     file_name = sys.argv[1]
-    bn = BayesianNetwork.xml_reader(file_name, "BayesianNet")
+    bn = BayesianNetwork.load_network(file_name, "BayesianNet")
     x = sys.argv[2]
-    e = {}
-    for index in range(3, len(sys.argv), 2):
-        e[sys.argv[index]] = bool(sys.argv[index+1])
-        index += 2
+    e = BayesianNetwork.parse_evidence(bn, sys.argv[3:])
     print(enumerate_ask(x, e, bn))
 
 
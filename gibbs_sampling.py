@@ -1,69 +1,349 @@
 import BayesianNetwork
-import random
+import instrumentation
+import numpy as np
+import time
+from concurrent.futures import ProcessPoolExecutor
 from exact_inferencer import normalize
+import shared_network
 import sys
 
 
-def gibbs_ask(x, e, bn, n):
+@instrumentation.instrumented("gibbs")
+def gibbs_ask(x, e, bn, n, rng=None):
     """
     Input:
         x, query variable
         e, given evidence
         bn, Bayesian net
         n, the total number of samples to be generated
+        rng, a UniformStream, numpy Generator, SeedSequence or seed
     Output:
         an estimate of P(X|e)
     """
-    count = [0, 0]
-    node_list = bn.get_nodelist()
-    current_state = {}
-    z = []
+    record = instrumentation.active()
+    if record is not None:
+        t = time.perf_counter()
+    plan = GibbsPlan(bn, e)
+    if record is not None:
+        t = instrumentation.lap(record, "plan", t)
+    state = plan.state
+    xi = plan.index[x]
+    count = [0] * plan.cards[xi]
+    uniforms = rng if isinstance(rng, BayesianNetwork.UniformStream) else BayesianNetwork.UniformStream(rng)
     """
     Initialization
     """
-    for node in node_list:
-        node_name = node.get_name()
-        if node_name in e:
-            current_state[node_name] = e[node_name]
-        else:
-            z.append(node_name)
-            random_val = random.choice([True, False])
-            current_state[node_name] = random_val
-
-    for time in range(n):
-        for val in z:
-            val_node = bn.get_node(val)
-            val_parent = val_node.get_parent()
-            p_distribution = []
-            for parent in val_parent:
-                p_distribution.append(current_state[parent])
-            p_true = val_node.get_probability(True, p_distribution)
-            p_false = val_node.get_probability(False, p_distribution)
-            val_children = val_node.get_children()
-            for child in val_children:
-                child_node = bn.get_node(child)
-                child_parent = child_node.get_parent()
-                
-                current_state[val] = True
-                cp_distribution = []
-                for parent in child_parent:
-                    cp_distribution.append(current_state[parent])
-                p_true *= child_node.get_probability(current_state[child], cp_distribution)
-
-                current_state[val] = False
-                cp_distribution.clear()
-                for parent in child_parent:
-                    cp_distribution.append(current_state[parent])
-                p_false *= child_node.get_probability(current_state[child], cp_distribution)
-
-            new = random.choices([True, False], [p_true, p_false])
-            current_state[val] = bool(new[0])
-            index = 0 if current_state[x] else 1
-            count[index] += 1
+    for i in plan.free:
+        state[i] = uniforms.integers(plan.cards[i])
+
+    # Uniforms are fetched for many sweeps at once
+    free = plan.free
+    block = max(1, uniforms.block // max(len(free), 1))
+    for start in range(0, n, block):
+        u = iter(uniforms.random(min(block, n - start) * len(free)).tolist())
+        for sweep in range(min(block, n - start)):
+            for i in free:
+                plan.resample(i, next(u))
+                count[state[xi]] += 1
+    if record is not None:
+        instrumentation.lap(record, "sampling", t)
+        record.samples += n
 
     return normalize(count)
 
 
+class GibbsPlan(object):
+    """
+    Class of Gibbs preparation: the network flattened for fast resampling.
+
+    The state of every variable is kept in the flat list state as a state
+    index (0 for True, 1 for False on binary nodes). Each non-evidence variable
+    gets its Markov blanket as indexes into state. When the blanket is small
+    enough, the full conditional P(X | blanket) is tabulated as cumulative
+    thresholds, so a resample is one table read and one uniform draw; otherwise
+    the CPT rows to multiply are gathered through precomputed parent indexes.
+    """
+    def __init__(self, bn, e, max_table_size=4096):
+        """
+        Initialization
+        Input:
+            bn, Bayesian net, or a FlatNetwork (whose CPTs are then used in
+                place, e.g. from shared memory)
+            e, given evidence (as state indexes for a FlatNetwork)
+            max_table_size, the largest conditional table to precompute
+        """
+        if isinstance(bn, shared_network.FlatNetwork):
+            self.flat = bn
+            self.nodes = None
+            self.names = bn.names
+            self.index = bn.index
+            self.cards = bn.cards.tolist()
+            self.cpts = [bn.rows(i) for i in range(len(bn.names))]
+            self.parents = [bn.parents_of(i).tolist() for i in range(len(bn.names))]
+            self.children = [bn.children_of(i).tolist() for i in range(len(bn.names))]
+        else:
+            bn.topological_order()
+            nodes = bn.get_nodelist()
+            e = bn.evidence_states(e)
+            self.nodes = nodes
+            self.names = [node.get_name() for node in nodes]
+            self.index = bn.index
+            self.cards = [node.get_cardinality() for node in nodes]
+            self.cpts = [node.cpt for node in nodes]
+            self.parents = [node.parent_ids.tolist() for node in nodes]
+            self.children = [node.child_ids.tolist() for node in nodes]
+        self.parent_cards = [[self.cards[p] for p in parents] for parents in self.parents]
+        self.state = [e.get(name, 0) for name in self.names]
+        self.free = [i for i, name in enumerate(self.names) if name not in e]
+        self.blankets = {}
+        self.tables = {}
+        for i in self.free:
+            blanket = set(self.parents[i]) | set(self.children[i])
+            for c in self.children[i]:
+                blanket.update(self.parents[c])
+            blanket.discard(i)
+            self.blankets[i] = sorted(blanket)
+            if np.prod([self.cards[j] for j in blanket]) <= max_table_size:
+                self.tables[i] = self.conditional_table(i)
+
+    def distribution(self, i, states):
+        """
+        Input:
+            i, a variable
+            states, an integer array of shape (rows, number of variables) with
+                one assignment per row (the column of i is ignored)
+        Output:
+            an array of shape (rows, states of i) holding the unnormalized
+            P(i|mb) of every row
+        """
+        dist = []
+        for value in range(self.cards[i]):
+            states[:, i] = value
+            p = self.cpts[i][self.row(i, states), value]
+            for c in self.children[i]:
+                p = p * self.cpts[c][self.row(c, states), states[:, c]]
+            dist.append(p)
+        return np.stack(dist, axis=1)
+
+    def row(self, i, states):
+        """
+        The CPT row of variable i for every assignment in states
+        """
+        return BayesianNetwork.parent_rows(states, self.parents[i], self.parent_cards[i],
+                                           states.shape[0])
+
+    def conditional_table(self, i):
+        """
+        Tabulate P(i | blanket) for every assignment of the blanket, in mixed
+        radix with the last blanket variable varying fastest. Each row holds
+        the cumulative thresholds of all states but the last.
+        """
+        blanket = self.blankets[i]
+        cards = [self.cards[j] for j in blanket]
+        rows = np.arange(int(np.prod(cards)))
+        states = np.zeros((len(rows), len(self.names)), dtype=np.intp)
+        states[:, blanket] = BayesianNetwork.index_to_assignment(rows, cards).reshape(len(rows), len(blanket))
+        return thresholds(self.distribution(i, states)).tolist()
+
+    def resample(self, i, u):
+        """
+        Draw a new value of variable i from its full conditional, u being a
+        uniform draw in [0, 1)
+        """
+        state = self.state
+        if i in self.tables:
+            index = 0
+            for j in self.blankets[i]:
+                index = index * self.cards[j] + state[j]
+            row = self.tables[i][index]
+        else:
+            row = thresholds(self.distribution(i, np.asarray([state], dtype=np.intp)))[0]
+        s = 0
+        for t in row:
+            if u < t:
+                break
+            s += 1
+        state[i] = s
+
+    def value(self, name):
+        """
+        The current value of a variable (True/False for a binary node, the
+        outcome name otherwise)
+        """
+        i = self.index[name]
+        if self.nodes is None:
+            return self.flat.state_value(i, self.state[i])
+        return self.nodes[i].state_value(self.state[i])
+
+
+def thresholds(dist):
+    """
+    Turn unnormalized distributions (one per row) into the cumulative
+    thresholds of all states but the last; an all-zero row becomes uniform
+    """
+    total = dist.sum(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dist = np.where(total > 0, dist / total, 1.0 / dist.shape[1])
+    return np.cumsum(dist, axis=1)[:, :-1]
+
+
+def gibbs_chain(x, e, bn, sweeps, rng, state=None, burn_in=0, thin=1):
+    """
+    Run one Gibbs chain
+    Input:
+        x, query variable
+        e, given evidence
+        bn, Bayesian net
+        sweeps, the number of sweeps to record after burn-in
+        rng, a numpy Generator owned by this chain (or a SeedSequence or seed)
+        state, the GibbsPlan state to continue from (default: a random initial state)
+        burn_in, the number of sweeps to run and discard first
+        thin, record one sweep out of every thin sweeps
+    Output:
+        trace, a list holding the state index of x for every recorded sweep
+        state, the final state of the chain
+        rng, the generator, advanced past the draws made by this call
+    """
+    plan = GibbsPlan(bn, e)
+    rng = np.random.default_rng(rng)
+    if state is None:
+        for i in plan.free:
+            plan.state[i] = int(rng.integers(plan.cards[i]))
+    else:
+        plan.state = state
+    xi = plan.index[x]
+    trace = []
+    for sweep in range(burn_in + sweeps * thin):
+        for i, u in zip(plan.free, rng.random(len(plan.free))):
+            plan.resample(i, u)
+        if sweep >= burn_in and (sweep - burn_in) % thin == thin - 1:
+            trace.append(plan.state[xi])
+    return trace, plan.state, rng
+
+
+def run_chain(args):
+    """
+    Process pool entry point for gibbs_chain; a NetworkHandle in place of
+    the network is attached to, so the network is shared rather than copied
+    """
+    if isinstance(args[2], shared_network.NetworkHandle):
+        args = args[:2] + (shared_network.attach(args[2]),) + args[3:]
+    return gibbs_chain(*args)
+
+
+def r_hat(traces):
+    """
+    Gelman-Rubin potential scale reduction factor
+    Input:
+        traces, a list of equally long traces, one per chain
+    Output:
+        R-hat (close to 1 once the chains have mixed)
+    """
+    chains = np.asarray(traces, dtype=np.float64)
+    m, length = chains.shape
+    if m < 2 or length < 2:
+        return float("inf")
+    within = chains.var(axis=1, ddof=1).mean()
+    between = length * chains.mean(axis=1).var(ddof=1)
+    if within == 0:
+        return 1.0 if between == 0 else float("inf")
+    var_hat = (length - 1) / length * within + between / length
+    return float(np.sqrt(var_hat / within))
+
+
+def state_r_hat(traces, k):
+    """
+    The largest R-hat over the indicator traces of the k states of a variable
+    """
+    return max(r_hat([np.equal(trace, s) for trace in traces]) for s in range(k))
+
+
+def effective_sample_size(trace):
+    """
+    Effective sample size of one trace, summing autocorrelations until the
+    first pair of lags whose sum is negative (Geyer's initial positive sequence)
+    """
+    chain = np.asarray(trace, dtype=np.float64)
+    length = len(chain)
+    chain = chain - chain.mean()
+    variance = chain.dot(chain) / length
+    if length < 2 or variance == 0:
+        return float(length)
+    acf = np.correlate(chain, chain, mode="full")[length - 1:] / (variance * length)
+    tau = -1.0
+    for lag in range(0, length - 1, 2):
+        pair = acf[lag] + acf[lag + 1]
+        if pair < 0:
+            break
+        tau += 2 * pair
+    return float(length / max(tau, 1.0 / length))
+
+
+@instrumentation.instrumented("parallel-gibbs")
+def parallel_gibbs_ask(x, e, bn, n, chains=4, burn_in=100, thin=1, seed=None,
+                       rhat_threshold=None, check_every=None, max_workers=None):
+    """
+    Run independent Gibbs chains on a process pool
+    Input:
+        x, query variable
+        e, given evidence
+        bn, Bayesian net
+        n, the largest number of recorded sweeps per chain
+        chains, the number of chains
+        burn_in, the number of sweeps each chain discards first
+        thin, record one sweep out of every thin sweeps
+        seed, a seed, SeedSequence or numpy Generator the independent chain
+            streams are spawned from
+        rhat_threshold, stop as soon as R-hat of x drops below this value
+        check_every, the number of recorded sweeps between two R-hat checks
+            (default: n, i.e. a single round)
+        max_workers, the size of the process pool
+    Output:
+        an estimate of P(X|e),
+        diagnostics holding, under "variables", R-hat, the effective sample
+        size and the number of recorded samples of x, and under "chains" and
+        "sweeps" the number of chains and of recorded sweeps per chain
+    """
+    k = bn.get_node(x).get_cardinality()
+    e = bn.evidence_states(e)
+    rngs = np.random.default_rng(seed).spawn(chains)
+    states = [None] * chains
+    traces = [[] for c in range(chains)]
+    step = check_every or n
+    # The workers attach to one shared copy of the network instead of
+    # unpickling it with every job
+    with shared_network.SharedNetwork(shared_network.flatten(bn)) as shared, \
+            ProcessPoolExecutor(max_workers=max_workers) as pool:
+        while len(traces[0]) < n:
+            sweeps = min(step, n - len(traces[0]))
+            skip = burn_in if states[0] is None else 0
+            jobs = [(x, e, shared.handle, sweeps, rngs[c], states[c], skip, thin)
+                    for c in range(chains)]
+            for c, (trace, state, rng) in enumerate(pool.map(run_chain, jobs)):
+                traces[c].extend(trace)
+                states[c] = state
+                rngs[c] = rng
+            if rhat_threshold is not None and state_r_hat(traces, k) < rhat_threshold:
+                break
+    counts = np.bincount(np.concatenate(traces).astype(np.intp), minlength=k)
+    record = instrumentation.active()
+    if record is not None:
+        record.samples += int(counts.sum())
+    diagnostics = {
+        "variables": {
+            x: {
+                "r_hat": state_r_hat(traces, k),
+                "ess": min(sum(effective_sample_size(np.equal(trace, s)) for trace in traces)
+                           for s in range(k)),
+                "samples": int(counts.sum()),
+            },
+        },
+        "chains": chains,
+        "sweeps": len(traces[0]),
+    }
+    return normalize(counts.tolist()), diagnostics
+
+
 def main():
     """
     Gibbs sampling main function
@@ -71,11 +351,8 @@ def main():
     n = int(sys.argv[1])
     file_name = sys.argv[2]
     x = sys.argv[3]
-    bn = BayesianNetwork.xml_reader(file_name, "BayesianNet")
-    e = {}
-    for index in range(4, len(sys.argv), 2):
-        e[sys.argv[index]] = bool(sys.argv[index+1])
-        index += 2
+    bn = BayesianNetwork.load_network(file_name, "BayesianNet")
+    e = BayesianNetwork.parse_evidence(bn, sys.argv[4:])
     print(gibbs_ask(x, e, bn, n))
 
 
@@ -0,0 +1,208 @@
+"""
+One entry point for every query: infer() looks at the network and the
+evidence and picks the algorithm.
+
+The network is first pruned to the part relevant to the query. Exact
+variable elimination is used when its largest intermediate factor (the
+product of the cardinalities of the largest clique of a min-fill
+triangulation) fits the budget. Otherwise a pilot batch of likelihood
+weighting estimates P(e) and how evenly the weights spread, and the query
+goes to the cheapest sampler that works at that level:
+
+    P(e) high enough for most samples to be kept   rejection sampling
+    weights spread well enough                     likelihood weighting
+    weights degenerate                             AIS-BN importance sampling
+    still degenerate after AIS-BN learning         Gibbs sampling
+
+A sampler is only used once some sample has shown that P(e) > 0. When no
+sample of the pilot or of the AIS-BN learning stage is consistent with the
+evidence, the answer is NaN with stopped set to "no_support": Gibbs
+sampling would otherwise report a precise-looking answer for evidence that
+may well be impossible.
+
+Samplers run as anytime streams, stopped at the budget's precision or
+deadline. Every choice is logged under the "infer" logger.
+"""
+import BayesianNetwork
+import anytime
+import elimination_order
+import logging
+import math
+import time
+import numpy as np
+from likelihood_weighting import kish_ess, learn_proposal, weighted_sample_batch
+from variable_elimination import elimination_ask
+import sys
+
+logger = logging.getLogger("infer")
+
+
+class Budget(object):
+    """
+    Class of accuracy and latency budget of a query
+    """
+    def __init__(self, precision=0.01, deadline=None, max_samples=anytime.MAX_SAMPLES,
+                 max_factor_entries=2 ** 22):
+        """
+        Initialization
+        Input:
+            precision, the target half-width of the 95% confidence intervals
+                of a sampled answer
+            deadline, the wall-clock budget of a sampled answer in seconds
+            max_samples, the largest number of samples to generate
+            max_factor_entries, exact elimination is used when no
+                intermediate factor has more entries than this (2^22 entries
+                take 32 MB)
+        """
+        self.precision = precision
+        self.deadline = deadline
+        self.max_samples = max_samples
+        self.max_factor_entries = max_factor_entries
+
+
+# Thresholds of the sampler choice, on the pilot batch
+PILOT_SAMPLES = 2000
+LEARNING_BATCH = 10000
+MIN_ACCEPTANCE = 0.2
+MIN_ESS_FRACTION = 0.05
+
+
+def exact_cost(bn, e):
+    """
+    Input:
+        bn, a Bayesian network
+        e, observed values for variables E
+    Output:
+        width, the induced width of the min-fill elimination order
+        entries, the number of entries of the largest intermediate factor
+    """
+    order, width = elimination_order.elimination_order(bn, e)
+    cardinality = {}
+    for node in bn.get_nodelist():
+        cardinality[node.get_name()] = node.get_cardinality()
+    entries = 1
+    for clique in elimination_order.elimination_cliques(bn, order, e):
+        entries = max(entries, math.prod(cardinality[v] for v in clique))
+    return width, entries
+
+
+def pilot(bn, e, n=PILOT_SAMPLES, rng=None):
+    """
+    A batch of likelihood weighting that sizes up the evidence
+    Input:
+        bn, a Bayesian network
+        e, observed values for variables E
+        n, the number of samples
+        rng, a numpy Generator, SeedSequence or seed
+    Output:
+        p_e, the estimate of P(e) (the mean weight)
+        ess_fraction, Kish's effective sample size over n
+    """
+    samples, log_w = weighted_sample_batch(bn, e, n, rng)
+    with np.errstate(under="ignore"):
+        p_e = float(np.exp(log_w).mean())
+    return p_e, kish_ess(log_w) / n
+
+
+def choose_sampler(e, p_e, ess_fraction):
+    """
+    The name of the sampler for evidence e, given the pilot estimates (AIS-BN
+    may still hand over to Gibbs once its proposal is learned)
+    """
+    if not e or p_e >= MIN_ACCEPTANCE:
+        return "rejection"
+    if ess_fraction >= MIN_ESS_FRACTION:
+        return "likelihood"
+    return "adaptive-importance"
+
+
+def infer(bn, query, evidence={}, budget=None, rng=None):
+    """
+    Answer P(query|evidence) with the algorithm that suits the network
+    Input:
+        bn, a Bayesian network
+        query, the query variable
+        evidence, observed values for variables E
+        budget, a Budget (default: Budget())
+        rng, a numpy Generator, SeedSequence or seed for the samplers
+    Output:
+        an anytime.Estimate; its extra holds the algorithm chosen, the
+        induced width and largest factor of exact elimination and, when
+        sampled, the pilot estimates of P(e) and of the ESS fraction. An
+        exact answer has zero standard errors and stopped set to "exact";
+        when no sample supports the evidence, the distribution is NaN and
+        stopped is "no_support".
+    """
+    if budget is None:
+        budget = Budget()
+    start = time.perf_counter()
+    sub_bn, e = bn.prune(query, evidence)
+    width, entries = exact_cost(sub_bn, sub_bn.evidence_states(e))
+    extra = {"width": width, "largest_factor": entries}
+    if entries <= budget.max_factor_entries:
+        logger.info("P(%s | %s): elimination, induced width %d, largest factor %d entries",
+                    query, sorted(e), width, entries)
+        distribution = elimination_ask(query, e, sub_bn)
+        extra["algorithm"] = "elimination"
+        estimate = anytime.Estimate(distribution, [0.0] * len(distribution), math.inf, 0,
+                                    time.perf_counter() - start, extra)
+        estimate.stopped = "exact"
+        return estimate
+
+    rng = np.random.default_rng(rng)
+    p_e, ess_fraction = pilot(sub_bn, e, rng=rng)
+    algorithm = choose_sampler(e, p_e, ess_fraction)
+    extra.update({"algorithm": algorithm, "p_e": p_e, "ess_fraction": ess_fraction})
+    logger.info("P(%s | %s): %s, induced width %d, largest factor %d entries over %d, "
+                "pilot P(e) %.3g, ESS fraction %.3g",
+                query, sorted(e), algorithm, width, entries, budget.max_factor_entries,
+                p_e, ess_fraction)
+    if algorithm == "adaptive-importance":
+        proposal, ess = learn_proposal(sub_bn, e, batch_size=LEARNING_BATCH, rng=rng)
+        if not ess or max(ess) == 0:
+            logger.warning("P(%s | %s): no sample is consistent with the evidence, "
+                           "which may be impossible; no answer", query, sorted(e))
+            k = sub_bn.get_node(query).get_cardinality()
+            extra["algorithm"] = None
+            estimate = anytime.Estimate([math.nan] * k, [math.inf] * k, 0.0,
+                                        PILOT_SAMPLES + len(ess) * LEARNING_BATCH,
+                                        time.perf_counter() - start, extra)
+            estimate.stopped = "no_support"
+            return estimate
+        if ess[-1] / LEARNING_BATCH < MIN_ESS_FRACTION:
+            algorithm = "gibbs"
+            extra["algorithm"] = algorithm
+            logger.info("P(%s | %s): AIS-BN weights still degenerate (ESS fraction %.3g), "
+                        "gibbs", query, sorted(e), ess[-1] / LEARNING_BATCH)
+    if algorithm == "adaptive-importance":
+        stream = anytime.likelihood_stream(query, e, sub_bn, rng=rng, proposal=proposal)
+    else:
+        stream = anytime.STREAMS[algorithm](query, e, sub_bn, rng=rng)
+    deadline = budget.deadline
+    if deadline is not None:
+        deadline = max(deadline - (time.perf_counter() - start), 0.0)
+    estimate = anytime.run_until(stream, budget.precision, deadline, budget.max_samples)
+    estimate.extra.update(extra)
+    estimate.elapsed = time.perf_counter() - start
+    logger.info("P(%s | %s): %s stopped on %s after %d samples, ESS %.0f, %.3f s",
+                query, sorted(e), algorithm, estimate.stopped, estimate.samples,
+                estimate.ess, estimate.elapsed)
+    return estimate
+
+
+def main():
+    """
+    Automatic inference main function
+    Usage: infer.py precision deadline file_name x [evidence ...]
+    """
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    budget = Budget(float(sys.argv[1]), float(sys.argv[2]))
+    file_name = sys.argv[3]
+    x = sys.argv[4]
+    bn = BayesianNetwork.load_network(file_name, "BayesianNet")
+    e = BayesianNetwork.parse_evidence(bn, sys.argv[5:])
+    print(infer(bn, x, e, budget).as_dict())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+"""
+A long-running inference server. Networks are loaded once and queries are
+answered over newline-delimited JSON, on TCP or on a Unix socket.
+
+A request is one JSON object per line:
+    {"id": 1, "network": "aima-alarm.xml", "query": "B",
+     "evidence": {"J": true, "M": true}, "algorithm": "elimination"}
+Sampling algorithms also take "n" (the number of samples, default 10000)
+and "seed"; their answers are only cached when a seed is given, since an
+unseeded estimate is a fresh random draw every time.
+{"batch": [request, ...]} answers several requests in one round trip, and
+{"op": "stats"} returns the latency metrics and cache statistics.
+Every response carries the id of its request. Responses are strict JSON: a
+probability that cannot be estimated (no sample supported the evidence) is
+null.
+"""
+import BayesianNetwork
+import asyncio
+import json
+import math
+import socket
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from batch_inference import all_marginals
+from exact_inferencer import LRUCache, enumerate_ask
+from gibbs_sampling import gibbs_ask
+from likelihood_weighting import likelihood_weighting
+from rejection_sampling import rejection_sampling
+from variable_elimination import elimination_ask
+
+
+EXACT = {
+    "enumeration": enumerate_ask,
+    "elimination": elimination_ask,
+}
+
+SAMPLERS = {
+    "rejection": rejection_sampling,
+    "likelihood": likelihood_weighting,
+    "gibbs": gibbs_ask,
+}
+
+DEFAULT_SAMPLES = 10000
+
+# Networks loaded by this process, so worker processes load each one once
+worker_networks = {}
+
+
+def get_network(path):
+    """
+    Load a network through the compiled-network cache, once per process
+    """
+    if path not in worker_networks:
+        worker_networks[path] = BayesianNetwork.load_network(path, path)
+    return worker_networks[path]
+
+
+def run_query(network, x, e, algorithm, n, seed=None):
+    """
+    Worker entry point
+    Input:
+        network, a Bayesian network, or the path of one (process pools)
+        x, the query variable
+        e, observed values for variables E
+        algorithm, a name in EXACT or SAMPLERS
+        n, the number of samples for sampling algorithms
+        seed, the seed of the sampler (None for fresh entropy)
+    Output:
+        a distribution over X
+    """
+    if isinstance(network, str):
+        network = get_network(network)
+    if algorithm in EXACT:
+        return EXACT[algorithm](x, e, network)
+    return SAMPLERS[algorithm](x, e, network, n, rng=seed)
+
+
+def run_marginals(network, e, variables):
+    """
+    Worker entry point answering several elimination queries that share
+    their evidence with one call to all_marginals
+    """
+    if isinstance(network, str):
+        network = get_network(network)
+    return all_marginals(network, e, variables)
+
+
+class LatencyMetrics(object):
+    """
+    Class of per-algorithm latency metrics over a window of recent queries
+    """
+    def __init__(self, window=1000):
+        """
+        Initialization
+        """
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+
+    def record(self, algorithm, seconds):
+        """
+        Record the latency of one query
+        """
+        self.samples.setdefault(algorithm, deque(maxlen=self.window)).append(seconds)
+        self.counts[algorithm] = self.counts.get(algorithm, 0) + 1
+
+    def report(self):
+        """
+        Get the query count and the mean, p50, p95 and max latency (in
+        milliseconds) of every algorithm
+        """
+        res = {}
+        for algorithm, samples in self.samples.items():
+            ordered = sorted(samples)
+            res[algorithm] = {
+                "count": self.counts[algorithm],
+                "mean_ms": 1000 * sum(ordered) / len(ordered),
+                "p50_ms": 1000 * ordered[len(ordered) // 2],
+                "p95_ms": 1000 * ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+                "max_ms": 1000 * ordered[-1],
+            }
+        return res
+
+
+def json_safe(value):
+    """
+    A copy of a response with every NaN or infinite float replaced by None,
+    since JSON has no such numbers (a sampler that no sample supported
+    answers NaN)
+    """
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return dict((k, json_safe(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [json_safe(v) for v in value]
+    return value
+
+
+def error_response(request, err):
+    """
+    The response reporting that a request failed with err
+    """
+    return {"id": request.get("id"), "error": "%s: %s" % (type(err).__name__, err)}
+
+
+class InferenceServer(object):
+    """
+    Class of inference server
+    """
+    def __init__(self, networks=[], cache_size=10000, workers=None, processes=False):
+        """
+        Initialization
+        Input:
+            networks, paths of networks to load up front (others are loaded
+                on first use)
+            cache_size, the number of results kept in the LRU cache
+            workers, the size of the worker pool
+            processes, whether to use a process pool instead of threads
+        """
+        self.processes = processes
+        if processes:
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.cache = LRUCache(cache_size)
+        self.metrics = LatencyMetrics()
+        for path in networks:
+            get_network(path)
+
+    async def network(self, path):
+        """
+        Get a network for use on the event loop; a first load runs on a
+        thread, so it does not hold up the other connections
+        """
+        if path in worker_networks:
+            return worker_networks[path]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, get_network, path)
+
+    async def cache_key(self, request):
+        """
+        Validate a query request and get its cache key
+        Output:
+            (network, query, canonicalized evidence, algorithm, n, seed), the
+            evidence being turned into sorted (name, state index) pairs so
+            equal evidence written differently shares an entry; None for a
+            sampler request without seed, which must not be cached
+        """
+        bn = await self.network(request["network"])
+        if bn.get_node(request["query"]) is None:
+            raise ValueError("%s is not a variable of %s" % (request["query"], request["network"]))
+        e = bn.evidence_states(request.get("evidence", {}))
+        algorithm = request.get("algorithm", "elimination")
+        n = None
+        if algorithm in SAMPLERS:
+            if request.get("seed") is None:
+                return None
+            n = request.get("n", DEFAULT_SAMPLES)
+        return (request["network"], request["query"], tuple(sorted(e.items())),
+                algorithm, n, request.get("seed"))
+
+    def worker_network(self, path):
+        """
+        What to hand to a worker: the network itself for threads, its path
+        for processes (which load their own copy once)
+        """
+        return path if self.processes else get_network(path)
+
+    async def answer(self, request):
+        """
+        Answer one query request
+        """
+        start = time.perf_counter()
+        algorithm = request.get("algorithm", "elimination")
+        if algorithm not in EXACT and algorithm not in SAMPLERS:
+            raise ValueError("Unknown algorithm %s" % algorithm)
+        key = await self.cache_key(request)
+        result = self.cache.get(key) if key is not None else None
+        cached = result is not None
+        if not cached:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                self.pool, run_query, self.worker_network(request["network"]), request["query"],
+                request.get("evidence", {}), algorithm, request.get("n", DEFAULT_SAMPLES),
+                request.get("seed"))
+            if key is not None:
+                self.cache.put(key, result)
+        latency = time.perf_counter() - start
+        self.metrics.record(algorithm, latency)
+        return {"id": request.get("id"), "result": result, "cached": cached,
+                "latency_ms": 1000 * latency}
+
+    async def answer_batch(self, requests):
+        """
+        Answer a batch of requests. Elimination queries that share a network
+        and evidence are answered together by one all_marginals call; the
+        rest run concurrently on the worker pool.
+        """
+        responses = [None] * len(requests)
+        keys = [None] * len(requests)
+        groups = {}
+        others = []
+        for i, request in enumerate(requests):
+            try:
+                key = keys[i] = await self.cache_key(request)
+            except Exception as err:
+                responses[i] = error_response(request, err)
+                continue
+            if key is None:
+                others.append(i)
+                continue
+            result = self.cache.get(key)
+            if result is not None:
+                self.metrics.record(key[3], 0.0)
+                responses[i] = {"id": request.get("id"), "result": result, "cached": True,
+                                "latency_ms": 0.0}
+            elif key[3] == "elimination":
+                groups.setdefault((key[0], key[2]), []).append(i)
+            else:
+                others.append(i)
+
+        async def group(members):
+            start = time.perf_counter()
+            request = requests[members[0]]
+            variables = list(set(requests[i]["query"] for i in members))
+            loop = asyncio.get_running_loop()
+            try:
+                res = await loop.run_in_executor(
+                    self.pool, run_marginals, self.worker_network(request["network"]),
+                    request.get("evidence", {}), variables)
+                results = [res[requests[i]["query"]] for i in members]
+            except Exception:
+                # One bad query fails the shared call: answer the members one
+                # at a time, so only the bad ones get an error
+                await asyncio.gather(*[single(i) for i in members])
+                return
+            latency = time.perf_counter() - start
+            for i, result in zip(members, results):
+                self.cache.put(keys[i], result)
+                self.metrics.record("elimination", latency)
+                responses[i] = {"id": requests[i].get("id"), "result": result, "cached": False,
+                                "latency_ms": 1000 * latency}
+
+        async def single(i):
+            responses[i] = await self.handle(requests[i])
+
+        await asyncio.gather(*([group(members) for members in groups.values()] +
+                               [single(i) for i in others]))
+        return responses
+
+    async def handle(self, request):
+        """
+        Dispatch one decoded request
+        """
+        try:
+            if request.get("op") == "stats":
+                return {"id": request.get("id"), "latency": self.metrics.report(),
+                        "cache": self.cache.info()}
+            if "batch" in request:
+                return {"id": request.get("id"), "batch": await self.answer_batch(request["batch"])}
+            return await self.answer(request)
+        except Exception as err:
+            return error_response(request, err)
+
+    async def connection(self, reader, writer):
+        """
+        Serve one client connection: one JSON request per line, one JSON
+        response per line, in order
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as err:
+                    response = {"error": "Invalid JSON: %s" % err}
+                else:
+                    response = await self.handle(request)
+                writer.write((json.dumps(json_safe(response), allow_nan=False) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8765, path=None):
+        """
+        Start listening on TCP (host, port), or on the Unix socket path
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(self.connection, path=path)
+        return await asyncio.start_server(self.connection, host, port)
+
+    async def serve_forever(self, host="127.0.0.1", port=8765, path=None):
+        """
+        Serve until cancelled
+        """
+        server = await self.start(host, port, path)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        """
+        Shut the worker pool down
+        """
+        self.pool.shutdown()
+
+
+class InferenceClient(object):
+    """
+    Class of blocking client stub for the inference server
+    """
+    def __init__(self, host="127.0.0.1", port=8765, path=None):
+        """
+        Connect over TCP (host, port), or to the Unix socket path
+        """
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.stream = self.sock.makefile("rwb")
+        self.next_id = 0
+
+    def request(self, request):
+        """
+        Send one request and wait for its response
+        """
+        self.next_id += 1
+        request = dict(request, id=self.next_id)
+        self.stream.write((json.dumps(request) + "\n").encode())
+        self.stream.flush()
+        return json.loads(self.stream.readline())
+
+    def query(self, network, x, e={}, algorithm="elimination", n=None, seed=None):
+        """
+        Ask for P(x | e) on a network
+        """
+        request = {"network": network, "query": x, "evidence": e, "algorithm": algorithm}
+        if n is not None:
+            request["n"] = n
+        if seed is not None:
+            request["seed"] = seed
+        return self.request(request)
+
+    def batch(self, requests):
+        """
+        Send several query requests in one round trip
+        Output:
+            one response per request, in order; a failed request gets a
+            response with an "error" entry instead of a result
+        """
+        response = self.request({"batch": requests})
+        if "error" in response:
+            raise RuntimeError("Batch failed on the server: %s" % response["error"])
+        return response["batch"]
+
+    def stats(self):
+        """
+        Get the latency metrics and cache statistics of the server
+        """
+        return self.request({"op": "stats"})
+
+    def close(self):
+        """
+        Close the connection
+        """
+        self.stream.close()
+        self.sock.close()
+
+
+def main():
+    """
+    Inference server main function
+    Usage: inference_server.py port|unix-socket-path [network.xml ...]
+    """
+    address = sys.argv[1]
+    server = InferenceServer(sys.argv[2:])
+    if address.isdigit():
+        asyncio.run(server.serve_forever(port=int(address)))
+    else:
+        asyncio.run(server.serve_forever(path=address))
+
+
+if __name__ == '__main__':
+    main()
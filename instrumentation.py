@@ -0,0 +1,227 @@
+"""
+Opt-in instrumentation of the inference engines.
+
+Nothing is recorded until enable() is called. While disabled, an
+instrumented entry point costs one flag check per query and the hot loops
+run unchanged (get_probability is only wrapped by a counting version while
+enabled). While enabled, every instrumented call produces a record holding
+its phase timings, factor sizes, peak intermediate width, get_probability
+call count and number of samples; records() returns them as dictionaries
+and prometheus() as Prometheus text exposition format.
+"""
+import functools
+import threading
+import time
+from collections import deque
+
+enabled = False
+completed = deque(maxlen=10000)
+local = threading.local()
+original_get_probability = None
+
+
+class QueryRecord(object):
+    """
+    Class of instrumentation record of one query
+    """
+    def __init__(self, engine, labels):
+        """
+        Initialization
+        Input:
+            engine, the name of the instrumented function
+            labels, extra identifying fields (query variable, network, ...)
+        """
+        self.engine = engine
+        self.labels = labels
+        self.phases = {}
+        self.counters = {}
+        self.factor_sizes = []
+        self.peak_width = 0
+        self.samples = 0
+        self.start = time.perf_counter()
+        self.elapsed = None
+
+    def add_time(self, phase, seconds):
+        """
+        Add seconds to the time spent in a phase
+        """
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, name, k=1):
+        """
+        Increase a counter
+        """
+        self.counters[name] = self.counters.get(name, 0) + k
+
+    def factor(self, f):
+        """
+        Record an intermediate factor: its number of entries, and its number
+        of variables towards the peak width
+        """
+        self.factor_sizes.append(int(f.values.size))
+        self.peak_width = max(self.peak_width, len(f.variables))
+
+    def as_dict(self):
+        """
+        The record as a dictionary
+        """
+        sampling = self.phases.get("sampling", self.elapsed)
+        return {
+            "engine": self.engine,
+            "labels": self.labels,
+            "elapsed": self.elapsed,
+            "phases": dict(self.phases),
+            "counters": dict(self.counters),
+            "factors": len(self.factor_sizes),
+            "largest_factor": max(self.factor_sizes) if self.factor_sizes else 0,
+            "peak_width": self.peak_width,
+            "samples": self.samples,
+            "samples_per_s": self.samples / sampling if self.samples and sampling else None,
+        }
+
+
+def active():
+    """
+    The record of the innermost instrumented call running in this thread,
+    or None (always None while disabled)
+    """
+    return getattr(local, "record", None)
+
+
+def lap(record, phase, start):
+    """
+    Add the time elapsed since start to a phase of record
+    Output:
+        the current time, to start the next phase from
+    """
+    now = time.perf_counter()
+    record.add_time(phase, now - start)
+    return now
+
+
+def instrumented(engine, label="query"):
+    """
+    Decorator making a function an instrumented entry point: while enabled,
+    each call gets its own QueryRecord, available to its body via active();
+    a string first argument is recorded under label
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            labels = {}
+            if args and isinstance(args[0], str):
+                labels[label] = args[0]
+            outer = active()
+            record = QueryRecord(engine, labels)
+            local.record = record
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record.elapsed = time.perf_counter() - record.start
+                local.record = outer
+                completed.append(record)
+        return wrapper
+    return decorator
+
+
+def counted_get_probability(self, node, parents=[]):
+    """
+    Node.get_probability, counted into the active record
+    """
+    record = active()
+    if record is not None:
+        record.count("get_probability")
+    return original_get_probability(self, node, parents)
+
+
+def enable():
+    """
+    Start recording
+    """
+    global enabled, original_get_probability
+    import BayesianNetwork
+    if not enabled:
+        original_get_probability = BayesianNetwork.Node.get_probability
+        BayesianNetwork.Node.get_probability = counted_get_probability
+    enabled = True
+
+
+def disable():
+    """
+    Stop recording (the records already collected are kept)
+    """
+    global enabled
+    import BayesianNetwork
+    if enabled:
+        BayesianNetwork.Node.get_probability = original_get_probability
+    enabled = False
+
+
+def reset():
+    """
+    Drop every collected record
+    """
+    completed.clear()
+
+
+def records():
+    """
+    The collected records, oldest first, as dictionaries
+    """
+    return [record.as_dict() for record in list(completed)]
+
+
+def escape_label(value):
+    """
+    Escape a Prometheus label value
+    """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus(prefix="bayesnet"):
+    """
+    The collected records aggregated per engine, in the Prometheus text
+    exposition format
+    """
+    queries = {}
+    seconds = {}
+    phases = {}
+    counters = {}
+    samples = {}
+    widths = {}
+    entries = {}
+    for record in list(completed):
+        engine = record.engine
+        queries[engine] = queries.get(engine, 0) + 1
+        seconds[engine] = seconds.get(engine, 0.0) + (record.elapsed or 0.0)
+        for phase, t in record.phases.items():
+            phases[(engine, phase)] = phases.get((engine, phase), 0.0) + t
+        for name, k in record.counters.items():
+            counters[(engine, name)] = counters.get((engine, name), 0) + k
+        samples[engine] = samples.get(engine, 0) + record.samples
+        widths[engine] = max(widths.get(engine, 0), record.peak_width)
+        entries[engine] = max([entries.get(engine, 0)] + record.factor_sizes)
+    lines = []
+
+    def family(name, kind, text, values):
+        lines.append("# HELP %s_%s %s" % (prefix, name, text))
+        lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+        for key in sorted(values):
+            if isinstance(key, tuple):
+                label = 'engine="%s",%s="%s"' % (escape_label(key[0]),
+                                                 "phase" if name.startswith("phase") else "counter",
+                                                 escape_label(key[1]))
+            else:
+                label = 'engine="%s"' % escape_label(key)
+            lines.append("%s_%s{%s} %r" % (prefix, name, label, values[key]))
+
+    family("queries_total", "counter", "Instrumented queries.", queries)
+    family("query_seconds_total", "counter", "Wall time of instrumented queries.", seconds)
+    family("phase_seconds_total", "counter", "Wall time per phase.", phases)
+    family("events_total", "counter", "Counted events such as get_probability calls.", counters)
+    family("samples_total", "counter", "Samples drawn.", samples)
+    family("peak_width", "gauge", "Most variables in one intermediate factor.", widths)
+    family("largest_factor_entries", "gauge", "Most entries in one intermediate factor.", entries)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,221 @@
+import BayesianNetwork
+import elimination_order
+import numpy as np
+from batch_inference import product, project
+from exact_inferencer import normalize
+import sys
+
+
+class JunctionTree(object):
+    """
+    Class of junction tree: a Bayesian network compiled into a tree of clique
+    potentials, queried with Shafer-Shenoy message passing.
+
+    Messages are cached between queries. Setting or retracting evidence on a
+    variable only changes the potential of its home clique, which invalidates
+    the messages directed away from that clique; every other message is reused.
+    """
+    def __init__(self, bn, heuristic="min-fill"):
+        """
+        Compile the network: triangulate, build the clique tree and assign
+        every CPT to a clique that contains its family
+        """
+        self.bn = bn
+        order = elimination_order.elimination_order(bn, heuristic=heuristic)[0]
+        position = {}
+        for i, var in enumerate(order):
+            position[var] = i
+        self.cliques = [sorted(c, key=position.get) for c in
+                        elimination_order.elimination_cliques(bn, order)]
+        self.neighbours = [[] for c in self.cliques]
+        self.separators = {}
+        self.build_tree()
+
+        self.home = {}
+        for var in order:
+            self.home[var] = min((i for i, c in enumerate(self.cliques) if var in c),
+                                 key=lambda i: len(self.cliques[i]))
+        assigned = [[] for c in self.cliques]
+        for node in bn.get_nodelist():
+            family = set([node.get_name()] + list(node.get_parent()))
+            i = min((i for i, c in enumerate(self.cliques) if family <= set(c)),
+                    key=lambda i: len(self.cliques[i]))
+            assigned[i].append(BayesianNetwork.make_factor(node, {}))
+        self.base = []
+        for i, c in enumerate(self.cliques):
+            shape = [bn.get_node(v).get_cardinality() for v in c]
+            f = product([BayesianNetwork.Factor(c, np.ones(shape))] + assigned[i])
+            self.base.append(BayesianNetwork.Factor(c, f.expand(c)))
+
+        self.evidence = {}
+        self.potentials = list(self.base)
+        self.messages = {}
+
+    def build_tree(self):
+        """
+        Connect the cliques with a maximum-weight spanning tree, the weight of
+        an edge being the size of the separator (Kruskal)
+        """
+        edges = []
+        for i in range(len(self.cliques)):
+            for j in range(i + 1, len(self.cliques)):
+                sep = set(self.cliques[i]) & set(self.cliques[j])
+                edges.append((-len(sep), i, j, sep))
+        edges.sort(key=lambda edge: edge[:3])
+        component = list(range(len(self.cliques)))
+
+        def find(i):
+            while component[i] != i:
+                component[i] = component[component[i]]
+                i = component[i]
+            return i
+
+        for weight, i, j, sep in edges:
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                component[ri] = rj
+                self.neighbours[i].append(j)
+                self.neighbours[j].append(i)
+                self.separators[(i, j)] = self.separators[(j, i)] = sep
+
+    def set_evidence(self, var, value):
+        """
+        Observe var = value (True/False, an outcome name or a state index)
+        """
+        state = self.bn.get_node(var).state_index(value)
+        if self.evidence.get(var) == state:
+            return
+        self.evidence[var] = state
+        self.refresh(self.home[var])
+
+    def retract_evidence(self, var):
+        """
+        Forget the observation of var
+        """
+        if var in self.evidence:
+            del self.evidence[var]
+            self.refresh(self.home[var])
+
+    def update_evidence(self, e):
+        """
+        Make e the current evidence, touching only the variables that changed
+        """
+        for var in list(self.evidence):
+            if var not in e:
+                self.retract_evidence(var)
+        for var in e:
+            self.set_evidence(var, e[var])
+
+    def refresh(self, i):
+        """
+        Recompute the potential of clique i from its CPTs and the evidence on
+        its home variables, then invalidate the messages directed away from it
+        """
+        f = self.base[i]
+        for var in self.cliques[i]:
+            if self.home[var] == i and var in self.evidence:
+                f = point_mass(f, var, self.evidence[var])
+        self.potentials[i] = f
+        stack = [(i, j) for j in self.neighbours[i]]
+        while stack:
+            src, dst = stack.pop()
+            if self.messages.pop((src, dst), None) is not None:
+                stack.extend((dst, k) for k in self.neighbours[dst] if k != src)
+
+    def message(self, src, dst):
+        """
+        The Shafer-Shenoy message from clique src to clique dst
+        """
+        if (src, dst) not in self.messages:
+            incoming = [self.messages[(k, src)] for k in self.neighbours[src] if k != dst]
+            f = product([self.potentials[src]] + incoming)
+            self.messages[(src, dst)] = project(f, self.separators[(src, dst)])
+        return self.messages[(src, dst)]
+
+    def collect(self, root):
+        """
+        Make sure every message directed towards root is available, computing
+        the missing ones leaves first
+        """
+        schedule = []
+        stack = [(root, None)]
+        while stack:
+            i, parent = stack.pop()
+            for j in self.neighbours[i]:
+                if j != parent:
+                    schedule.append((j, i))
+                    stack.append((j, i))
+        for src, dst in reversed(schedule):
+            self.message(src, dst)
+
+    def belief(self, i):
+        """
+        The unnormalized joint of clique i and the evidence
+        """
+        self.collect(i)
+        incoming = [self.messages[(k, i)] for k in self.neighbours[i]]
+        return product([self.potentials[i]] + incoming)
+
+    def marginal(self, x):
+        """
+        The distribution over x given the current evidence
+        """
+        if x in self.evidence:
+            res = [0.0] * self.bn.get_node(x).get_cardinality()
+            res[self.evidence[x]] = 1.0
+            return res
+        f = project(self.belief(self.home[x]), [x])
+        return normalize([float(v) for v in f.values])
+
+    def probability_of_evidence(self):
+        """
+        P(e) for the current evidence
+        """
+        total = 1.0
+        roots = set()
+        for i in range(len(self.cliques)):
+            if i in roots:
+                continue
+            total *= float(self.belief(i).values.sum())
+            stack = [i]
+            while stack:
+                j = stack.pop()
+                roots.add(j)
+                stack.extend(k for k in self.neighbours[j] if k not in roots)
+        return total
+
+    def query(self, x, e):
+        """
+        Input:
+            x, the query variable
+            e, observed values for variables E
+        Output:
+            a distribution over X
+        """
+        self.update_evidence(e)
+        return self.marginal(x)
+
+
+def point_mass(f, var, state):
+    """
+    Zero out the entries of f that disagree with var = state
+    """
+    mask = np.zeros(f.values.shape[f.axis(var)])
+    mask[state] = 1.0
+    mask = BayesianNetwork.Factor([var], mask)
+    return BayesianNetwork.Factor(f.variables, f.values * mask.expand(f.variables))
+
+
+def main():
+    """
+    Junction tree main function
+    """
+    file_name = sys.argv[1]
+    bn = BayesianNetwork.load_network(file_name, "BayesianNet")
+    x = sys.argv[2]
+    e = BayesianNetwork.parse_evidence(bn, sys.argv[3:])
+    print(JunctionTree(bn).query(x, e))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,58 +1,281 @@
 from exact_inferencer import normalize
-import random
+import math
+import time
+import numpy as np
 import BayesianNetwork
+import instrumentation
 import sys
 
 
-def likelihood_weighting(x, evidence, bn, n):
+@instrumentation.instrumented("likelihood")
+def likelihood_weighting(x, evidence, bn, n, batch_size=100000, rng=None):
     """
     Input:
         x, the query variable
         e, observed values for variables E
         bn, a Bayesian network specifying joint distribution P(X1,...,Xn)
         n, the total number of samples to be generated
+        batch_size, the number of samples drawn together by weighted_sample_batch
+        rng, a numpy Generator, SeedSequence or seed
     Output:
         an estimate of P(X|e)
+
+    The weights are accumulated as log-weights, shifted by the largest one
+    seen so far, so long evidence sets cannot underflow them to zero.
+    """
+    record = instrumentation.active()
+    if record is not None:
+        t = time.perf_counter()
+    k = bn.get_node(x).get_cardinality()
+    log_count = np.full(k, -np.inf)
+    rng = np.random.default_rng(rng)
+    for start in range(0, n, batch_size):
+        samples, log_w = weighted_sample_batch(bn, evidence, min(batch_size, n - start), rng)
+        log_count = np.logaddexp(log_count, log_bincount(samples[x], log_w, k))
+    if record is not None:
+        instrumentation.lap(record, "sampling", t)
+        record.samples += n
+    return normalize(log_count.tolist(), log=True)
+
+
+def log_bincount(states, log_w, k):
+    """
+    Input:
+        states, the state index of the query variable in every sample
+        log_w, the log-weight of every sample
+        k, the number of states
+    Output:
+        the log of the total weight of each state
+    """
+    m = log_w.max() if len(log_w) else -np.inf
+    if not np.isfinite(m):
+        return np.full(k, -np.inf)
+    with np.errstate(divide="ignore"):
+        return np.log(np.bincount(states, weights=np.exp(log_w - m), minlength=k)) + m
+
+
+def weighted_sample_batch(bn, e, n, rng=None):
+    """
+    Draw n weighted samples at once, one node at a time in topological order
+    Input:
+        bn, a Bayesian network
+        e, evidence
+        n, the number of samples
+        rng, a numpy Generator, SeedSequence or seed
+    Output:
+        samples, a dictionary mapping each variable to a uint8 array of length
+            n holding its state index in every sample (0 is True for a binary node)
+        log_w, the log-weight of each sample
     """
-    count = [0, 0]
-    for i in range(n):
-        sample = weighted_sample(bn, evidence)
-        w = sample["weight"]
-        index = 0 if sample[x] else 1
-        count[index] += w
-    return normalize(count)
+    rng = np.random.default_rng(rng)
+    e = bn.evidence_states(e)
+    log_w = np.zeros(n)
+    sampled = {}
+    for node in bn.get_sorted_nodelist():
+        node_name = node.get_name()
+        index = BayesianNetwork.parent_rows(sampled, node.get_parent(), node.parent_cards, n)
+        if node_name in e:
+            with np.errstate(divide="ignore"):
+                log_w += np.log(node.cpt[index, e[node_name]])
+            sampled[node_name] = np.full(n, e[node_name], dtype=np.uint8)
+        else:
+            sampled[node_name] = BayesianNetwork.sample_states(node.cpt[index], rng.random(n))
+    return sampled, log_w
 
 
-def weighted_sample(bn, e):
+def weighted_sample(bn, e, log=False, rng=None):
     """
     Input:
         bn, a Bayesian network
         e, evidence
+        log, whether to accumulate and return the log-weight instead of the weight
+        rng, a UniformStream, numpy Generator, SeedSequence or seed
     Output:
         x, an event
         w, a weight
     """
-    w = 1.0
+    w = 0.0 if log else 1.0
     sampled = {}
     for key in e:
         sampled[key] = e[key]
-    node_list = bn.get_nodelist()
-    for node in node_list:
+    states = bn.evidence_states(e)
+    node_list = bn.get_sorted_nodelist()
+    u = BayesianNetwork.uniform_source(rng).random(len(node_list))
+    for node, draw in zip(node_list, u):
         parent_val = []
         node_parent = node.get_parent()
         node_name = node.get_name()
         for parent in node_parent:
-            parent_val.append(sampled[parent])
+            parent_val.append(states[parent])
         if node_name in e:
-            w = w * node.get_probability(e[node_name], parent_val)
+            p = node.get_probability(states[node_name], parent_val)
+            if log:
+                w = w + (math.log(p) if p > 0 else -math.inf)
+            else:
+                w = w * p
         else:
-            p_distribution = [node.get_probability(True, parent_val), node.get_probability(False, parent_val)]
-            val = random.choices([True, False], p_distribution)
-            sampled[node_name] = bool(val[0])
+            val = BayesianNetwork.sample_state(node.cpt[node.get_index(parent_val)].tolist(), draw)
+            states[node_name] = val
+            sampled[node_name] = node.state_value(val)
     sampled["weight"] = w
     return sampled
 
 
+def importance_sample_batch(bn, e, n, proposal, rng=None):
+    """
+    Draw n weighted samples with the non-evidence nodes drawn from proposal
+    CPTs instead of their own
+    Input:
+        bn, a Bayesian network
+        e, evidence
+        n, the number of samples
+        proposal, a dictionary mapping nodes to proposal CPTs shaped like
+            node.cpt; nodes it does not mention are drawn from their CPT
+        rng, a numpy Generator, SeedSequence or seed
+    Output:
+        samples, as weighted_sample_batch
+        log_w, the log importance weight of each sample: log P(x, e) minus
+            the log-probability of drawing x under the proposal
+    """
+    rng = np.random.default_rng(rng)
+    e = bn.evidence_states(e)
+    log_w = np.zeros(n)
+    sampled = {}
+    for node in bn.get_sorted_nodelist():
+        node_name = node.get_name()
+        index = BayesianNetwork.parent_rows(sampled, node.get_parent(), node.parent_cards, n)
+        with np.errstate(divide="ignore"):
+            if node_name in e:
+                log_w += np.log(node.cpt[index, e[node_name]])
+                sampled[node_name] = np.full(n, e[node_name], dtype=np.uint8)
+            elif node_name in proposal:
+                q = proposal[node_name]
+                states = BayesianNetwork.sample_states(q[index], rng.random(n))
+                log_w += np.log(node.cpt[index, states]) - np.log(q[index, states])
+                sampled[node_name] = states
+            else:
+                sampled[node_name] = BayesianNetwork.sample_states(node.cpt[index], rng.random(n))
+    return sampled, log_w
+
+
+def kish_ess(log_w):
+    """
+    Kish's effective sample size (sum w)^2 / sum w^2 of a batch of log-weights
+    """
+    m = log_w.max() if len(log_w) else -np.inf
+    if not np.isfinite(m):
+        return 0.0
+    w = np.exp(log_w - m)
+    return float(w.sum() ** 2 / w.dot(w))
+
+
+def learn_proposal(bn, e, batch_size=10000, updates=10, epsilon=None, rng=None):
+    """
+    The learning stage of AIS-BN (Cheng and Druzdzel, 2000)
+    Input:
+        bn, a Bayesian network
+        e, observed values for variables E
+        batch_size, the number of samples per learning batch
+        updates, the number of learning batches
+        epsilon, probabilities below this are raised to it in the initial
+            proposal, so that no state is left unexplored (default: 0.04 for
+            binary nodes, scaled down with the number of states)
+        rng, a numpy Generator, SeedSequence or seed
+    Output:
+        proposal, a dictionary mapping node names to proposal CPTs, to be
+            passed to importance_sample_batch
+        ess, the effective sample size of every learning batch
+
+    Only the non-evidence ancestors of the evidence get a proposal: the
+    posterior of every other node given its parents is its own CPT. Each
+    learning batch estimates P(node | parents, e) from its weighted samples,
+    and the proposal moves towards it with a learning rate decaying from
+    0.4 to 0.14.
+    """
+    rng = np.random.default_rng(rng)
+    e = bn.evidence_states(e)
+    proposal = {}
+    for name in bn.ancestors(list(e)):
+        if name in e:
+            continue
+        node = bn.get_node(name)
+        k = node.get_cardinality()
+        floor = epsilon if epsilon is not None else 0.08 / k
+        q = np.maximum(node.cpt, floor)
+        proposal[name] = q / q.sum(axis=1, keepdims=True)
+
+    ess = []
+    if not proposal:
+        updates = 0
+    for t in range(updates):
+        samples, log_w = importance_sample_batch(bn, e, batch_size, proposal, rng)
+        ess.append(kish_ess(log_w))
+        m = log_w.max()
+        if not np.isfinite(m):
+            continue
+        w = np.exp(log_w - m)
+        rate = 0.4 * (0.14 / 0.4) ** (t / max(updates - 1, 1))
+        for name, q in proposal.items():
+            node = bn.get_node(name)
+            rows, k = q.shape
+            index = BayesianNetwork.parent_rows(samples, node.get_parent(), node.parent_cards,
+                                                batch_size)
+            counts = np.bincount(index * k + samples[name], weights=w,
+                                 minlength=rows * k).reshape(rows, k)
+            total = counts.sum(axis=1, keepdims=True)
+            seen = total[:, 0] > 0
+            q[seen] += rate * (counts[seen] / total[seen] - q[seen])
+    return proposal, ess
+
+
+@instrumentation.instrumented("adaptive-importance")
+def adaptive_importance_sampling(x, evidence, bn, n, batch_size=10000, updates=10,
+                                 epsilon=None, rng=None):
+    """
+    AIS-BN (Cheng and Druzdzel, 2000): learn proposal CPTs close to the
+    posterior given the evidence, then importance sample from them
+    Input:
+        x, the query variable
+        evidence, observed values for variables E
+        bn, a Bayesian network
+        n, the number of samples drawn after the learning stage
+        batch_size, the number of samples per batch
+        updates, epsilon, as learn_proposal
+        rng, a numpy Generator, SeedSequence or seed
+    Output:
+        an estimate of P(X|e),
+        a report holding the effective sample size of every batch (learning
+            batches first) and the number of samples drawn in total
+
+    The samples of the learning stage only shape the proposal; the estimate
+    uses the n samples drawn afterwards.
+    """
+    record = instrumentation.active()
+    if record is not None:
+        clock = time.perf_counter()
+    rng = np.random.default_rng(rng)
+    e = bn.evidence_states(evidence)
+    proposal, ess = learn_proposal(bn, e, batch_size, updates, epsilon, rng)
+    if record is not None:
+        clock = instrumentation.lap(record, "learning", clock)
+    k = bn.get_node(x).get_cardinality()
+    log_count = np.full(k, -np.inf)
+    for start in range(0, n, batch_size):
+        samples, log_w = importance_sample_batch(bn, e, min(batch_size, n - start), proposal, rng)
+        ess.append(kish_ess(log_w))
+        log_count = np.logaddexp(log_count, log_bincount(samples[x], log_w, k))
+    learning = (len(ess) - (n + batch_size - 1) // batch_size) * batch_size
+    report = {
+        "ess": ess,
+        "samples": n + learning,
+    }
+    if record is not None:
+        instrumentation.lap(record, "sampling", clock)
+        record.samples += n
+        record.count("learning_samples", learning)
+    return normalize(log_count.tolist(), log=True), report
+
+
 def main():
     """
     Likelihood weighting main function
@@ -60,11 +283,8 @@ def main():
     n = int(sys.argv[1])
     file_name = sys.argv[2]
     x = sys.argv[3]
-    bn = BayesianNetwork.xml_reader(file_name, "BayesianNet")
-    e = {}
-    for index in range(4, len(sys.argv), 2):
-        e[sys.argv[index]] = bool(sys.argv[index+1])
-        index += 2
+    bn = BayesianNetwork.load_network(file_name, "BayesianNet")
+    e = BayesianNetwork.parse_evidence(bn, sys.argv[4:])
     print(likelihood_weighting(x, e, bn, n))
 
 
@@ -1,46 +1,138 @@
 import BayesianNetwork
-import random
+import instrumentation
+import numpy as np
+import time
 from exact_inferencer import normalize
 import sys
 
 
-def prior_sample(bn):
+def prior_sample(bn, rng=None):
     """
     Input:
-        A Bayesian network
+        A Bayesian network,
+        rng, a UniformStream, numpy Generator, SeedSequence or seed
     Output:
         A randomly sampled event from the prior specified by input Bayes net
     """
-    node_list = bn.get_nodelist()
+    node_list = bn.get_sorted_nodelist()
+    u = BayesianNetwork.uniform_source(rng).random(len(node_list))
     sampled = {}
-    for node in node_list:
+    states = {}
+    for node, draw in zip(node_list, u):
         parent_val = []
         node_parent = node.get_parent()
         for parent in node_parent:
-            parent_val.append(sampled[parent])
-        p_distribution = [node.get_probability(True, parent_val), node.get_probability(False, parent_val)]
-        val = random.choices([True, False], p_distribution)
-        sampled[node.get_name()] = bool(val[0])
+            parent_val.append(states[parent])
+        val = BayesianNetwork.sample_state(node.cpt[node.get_index(parent_val)].tolist(), draw)
+        states[node.get_name()] = val
+        sampled[node.get_name()] = node.state_value(val)
     return sampled
 
 
-def rejection_sampling(x, e, bn, n):
+def prior_sample_batch(bn, n, e={}, rng=None):
+    """
+    Draw n events from the prior at once, rejecting early
+    Input:
+        bn, a Bayesian network
+        n, the number of events to draw
+        e, evidence: a row is dropped as soon as it disagrees with an
+            evidence variable, so later nodes never process it
+        rng, a numpy Generator, SeedSequence or seed
+    Output:
+        a dictionary mapping each variable to a uint8 array holding its state
+        index in every accepted event (0 is True for a binary node)
+    """
+    rng = np.random.default_rng(rng)
+    e = bn.evidence_states(e)
+    sampled = {}
+    for node in bn.get_sorted_nodelist():
+        node_name = node.get_name()
+        index = BayesianNetwork.parent_rows(sampled, node.get_parent(), node.parent_cards, n)
+        sampled[node_name] = BayesianNetwork.sample_states(node.cpt[index], rng.random(n))
+        if node_name in e:
+            keep = sampled[node_name] == e[node_name]
+            n = int(keep.sum())
+            for name in sampled:
+                sampled[name] = sampled[name][keep]
+    return sampled
+
+
+@instrumentation.instrumented("rejection")
+def rejection_sampling(x, e, bn, n, batch_size=100000, rng=None):
     """
     Input:
         x, the query variable
         e, observed values for variables E
         bn, a Bayesian network
         N, the total number of samples to be generated
+        batch_size, the number of samples drawn together by prior_sample_batch
+        rng, a numpy Generator, SeedSequence or seed
     Output:
         estimate of probability x given evidence e
     """
-    counts = [0, 0]
-    for num in range(n):
-        event = prior_sample(bn)
-        if consistent(event, e):
-            index = 0 if event[x] else 1
-            counts[index] += 1
-    return normalize(counts)
+    record = instrumentation.active()
+    if record is not None:
+        t = time.perf_counter()
+    k = bn.get_node(x).get_cardinality()
+    counts = np.zeros(k, dtype=np.int64)
+    rng = np.random.default_rng(rng)
+    for start in range(0, n, batch_size):
+        event = prior_sample_batch(bn, min(batch_size, n - start), e, rng)
+        counts += np.bincount(event[x], minlength=k)
+    if record is not None:
+        instrumentation.lap(record, "sampling", t)
+        record.samples += n
+        record.count("accepted", int(counts.sum()))
+    return normalize(counts.tolist())
+
+
+@instrumentation.instrumented("rejection")
+def rejection_sampling_until(x, e, bn, target, batch_size=10000, max_samples=10**8, rng=None):
+    """
+    Stream batches of samples until enough of them agree with the evidence
+    Input:
+        x, the query variable
+        e, observed values for variables E
+        bn, a Bayesian network
+        target, the number of accepted samples to collect
+        batch_size, the size of the first batch; later batches are sized from
+            the observed acceptance rate
+        max_samples, the largest number of samples to generate in total
+        rng, a numpy Generator, SeedSequence or seed
+    Output:
+        estimate of probability x given evidence e,
+        a report with the number of generated and accepted samples, the
+        acceptance rate and the effective sample count
+    """
+    k = bn.get_node(x).get_cardinality()
+    counts = np.zeros(k, dtype=np.int64)
+    generated = 0
+    rng = np.random.default_rng(rng)
+    size = batch_size
+    while counts.sum() < target and generated < max_samples:
+        size = min(size, max_samples - generated)
+        event = prior_sample_batch(bn, size, e, rng)
+        generated += size
+        counts += np.bincount(event[x], minlength=k)
+        total = int(counts.sum())
+        if total:
+            missing = target - total
+            size = max(batch_size, min(int(missing * generated / total * 1.1) + 1, 10 * batch_size))
+        else:
+            size = 10 * batch_size
+    total = int(counts.sum())
+    record = instrumentation.active()
+    if record is not None:
+        record.samples += generated
+        record.count("accepted", total)
+    report = {
+        "generated": generated,
+        "accepted": total,
+        "acceptance_rate": total / generated if generated else 0.0,
+        # Accepted samples are independent draws from P(X|e) with equal weight
+        "effective_samples": total,
+    }
+    return normalize(counts.tolist()), report
 
 
 def consistent(x, e):
@@ -67,11 +159,8 @@ def main():
     n = int(sys.argv[1])
     file_name = sys.argv[2]
     x = sys.argv[3]
-    bn = BayesianNetwork.xml_reader(file_name, "BayesianNet")
-    e = {}
-    for index in range(4, len(sys.argv), 2):
-        e[sys.argv[index]] = bool(sys.argv[index+1])
-        index += 2
+    bn = BayesianNetwork.load_network(file_name, "BayesianNet")
+    e = BayesianNetwork.parse_evidence(bn, sys.argv[4:])
     print(rejection_sampling(x, e, bn, n))
 
 
@@ -0,0 +1,315 @@
+"""
+A Bayesian network as a handful of flat arrays, so worker processes can
+share one copy instead of each unpickling the whole object graph.
+
+The arrays are laid out back to back in one buffer: a multiprocessing
+shared memory block, or a file mapped with np.memmap. A SharedNetwork owns
+the buffer; its handle is a small picklable object that workers pass to
+attach() to get a FlatNetwork whose arrays are views into the buffer.
+"""
+import BayesianNetwork
+import instrumentation
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from exact_inferencer import normalize
+from likelihood_weighting import log_bincount
+from multiprocessing import shared_memory
+
+
+FIELDS = [
+    ("cards", np.int32),
+    ("cpt", np.float64),
+    ("cpt_ptr", np.int64),
+    ("parents", np.int32),
+    ("parent_ptr", np.int64),
+    ("children", np.int32),
+    ("child_ptr", np.int64),
+    ("order", np.int32),
+]
+
+
+class FlatNetwork(object):
+    """
+    Class of flat network: CPT values with per-node offsets, parents and
+    children in compressed sparse row form, and the topological order
+    """
+    def __init__(self, names, outcomes, arrays, buffer=None):
+        """
+        Initialization
+        Input:
+            names, the variable names, indexed by node ID
+            outcomes, the outcome names of every variable
+            arrays, a dictionary holding one array per entry of FIELDS
+            buffer, the shared memory block or memory map the arrays view
+                (kept so that it outlives them)
+        """
+        self.names = names
+        self.outcomes = outcomes
+        self.index = dict((name, i) for i, name in enumerate(names))
+        for field, dtype in FIELDS:
+            setattr(self, field, arrays[field])
+        self.buffer = buffer
+
+    def rows(self, i):
+        """
+        The CPT of node i as a (parent assignments, states) view
+        """
+        return self.cpt[self.cpt_ptr[i]: self.cpt_ptr[i+1]].reshape(-1, self.cards[i])
+
+    def parents_of(self, i):
+        """
+        The parent IDs of node i
+        """
+        return self.parents[self.parent_ptr[i]: self.parent_ptr[i+1]]
+
+    def children_of(self, i):
+        """
+        The child IDs of node i
+        """
+        return self.children[self.child_ptr[i]: self.child_ptr[i+1]]
+
+    def state_value(self, i, s):
+        """
+        The value of state s of node i (True/False for a binary node, the
+        outcome name otherwise), as Node.state_value
+        """
+        if self.cards[i] == 2:
+            return s == 0
+        return self.outcomes[i][s]
+
+
+def flatten(bn):
+    """
+    Input:
+        a Bayesian network
+    Output:
+        the FlatNetwork holding the same CPTs and graph
+    """
+    nodes = bn.get_nodelist()
+    order = bn.topological_order()
+    arrays = {
+        "cards": [node.get_cardinality() for node in nodes],
+        "cpt": np.concatenate([node.cpt.ravel() for node in nodes] + [np.zeros(0)]),
+        "cpt_ptr": np.cumsum([0] + [node.cpt.size for node in nodes]),
+        "parents": np.concatenate([node.parent_ids for node in nodes] + [np.zeros(0)]),
+        "parent_ptr": np.cumsum([0] + [len(node.parent_ids) for node in nodes]),
+        "children": np.concatenate([node.child_ids for node in nodes] + [np.zeros(0)]),
+        "child_ptr": np.cumsum([0] + [len(node.child_ids) for node in nodes]),
+        "order": order,
+    }
+    for field, dtype in FIELDS:
+        arrays[field] = np.asarray(arrays[field], dtype=dtype)
+    outcomes = [list(node.outcomes) for node in nodes]
+    return FlatNetwork([node.get_name() for node in nodes], outcomes, arrays)
+
+
+class NetworkHandle(object):
+    """
+    Class of picklable reference to a shared flat network
+    """
+    def __init__(self, kind, location, layout, size, names, outcomes):
+        """
+        Initialization
+        Input:
+            kind, "shm" for a shared memory block or "file" for a mapped file
+            location, the name of the block or the path of the file
+            layout, the (field, offset, length) of every array
+            size, the size of the buffer in bytes
+            names, outcomes, as FlatNetwork
+        """
+        self.kind = kind
+        self.location = location
+        self.layout = layout
+        self.size = size
+        self.names = names
+        self.outcomes = outcomes
+
+
+class SharedNetwork(object):
+    """
+    Class of owner of a shared flat network. Use it as a context manager, or
+    call close() when the workers are done; the buffer is then released.
+    """
+    def __init__(self, flat, path=None):
+        """
+        Copy a FlatNetwork into a new shared memory block, or into the file
+        path (to be memory-mapped) if one is given
+        """
+        layout = []
+        size = 0
+        for field, dtype in FIELDS:
+            array = getattr(flat, field)
+            layout.append((field, size, len(array)))
+            # Every array starts on an 8-byte boundary
+            size += (array.nbytes + 7) // 8 * 8
+        size = max(size, 8)
+        if path is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            buffer = self.shm.buf
+            location = self.shm.name
+        else:
+            self.shm = None
+            buffer = np.memmap(path, dtype=np.uint8, mode="w+", shape=(size,))
+            location = path
+        for field, dtype in FIELDS:
+            offset, length = [(o, n) for f, o, n in layout if f == field][0]
+            view = np.ndarray((length,), dtype=dtype, buffer=buffer, offset=offset)
+            view[:] = getattr(flat, field)
+        if path is not None:
+            buffer.flush()
+            del buffer
+        self.handle = NetworkHandle("file" if path else "shm", location, layout, size,
+                                    flat.names, flat.outcomes)
+
+    def close(self):
+        """
+        Release the buffer (the file of a memory-mapped network is kept)
+        """
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Networks attached by this process, by location
+attached = {}
+
+
+def attach(handle):
+    """
+    Input:
+        a NetworkHandle
+    Output:
+        a FlatNetwork viewing the shared buffer, without copying it; each
+        process attaches to a given buffer only once
+    """
+    if handle.location in attached:
+        return attached[handle.location]
+    if handle.kind == "shm":
+        buffer = shared_memory.SharedMemory(name=handle.location)
+        data = buffer.buf
+    else:
+        buffer = np.memmap(handle.location, dtype=np.uint8, mode="r", shape=(handle.size,))
+        data = buffer
+    arrays = {}
+    for (field, dtype), (name, offset, length) in zip(FIELDS, handle.layout):
+        arrays[field] = np.ndarray((length,), dtype=dtype, buffer=data, offset=offset)
+    flat = FlatNetwork(handle.names, handle.outcomes, arrays, buffer)
+    attached[handle.location] = flat
+    return flat
+
+
+def flat_prior_sample(flat, n, e={}, rng=None):
+    """
+    Draw n events from the prior, rejecting early (as prior_sample_batch)
+    Input:
+        flat, a FlatNetwork
+        n, the number of events to draw
+        e, evidence mapping names to state indexes
+        rng, a numpy Generator, SeedSequence or seed
+    Output:
+        a uint8 array of shape (accepted events, variables) holding the state
+        index of every variable, in node ID order
+    """
+    rng = np.random.default_rng(rng)
+    e = dict((flat.index[name], state) for name, state in e.items())
+    states = np.zeros((n, len(flat.names)), dtype=np.uint8)
+    for i in flat.order:
+        parents = flat.parents_of(i)
+        index = BayesianNetwork.parent_rows(states, parents, flat.cards[parents], len(states))
+        states[:, i] = BayesianNetwork.sample_states(flat.rows(i)[index], rng.random(len(states)))
+        if i in e:
+            states = states[states[:, i] == e[i]]
+    return states
+
+
+def flat_weighted_sample(flat, n, e, rng=None):
+    """
+    Draw n weighted samples (as weighted_sample_batch)
+    Input:
+        flat, a FlatNetwork
+        n, the number of samples
+        e, evidence mapping names to state indexes
+        rng, a numpy Generator, SeedSequence or seed
+    Output:
+        states, a uint8 array of shape (n, variables)
+        log_w, the log-weight of each sample
+    """
+    rng = np.random.default_rng(rng)
+    e = dict((flat.index[name], state) for name, state in e.items())
+    states = np.zeros((n, len(flat.names)), dtype=np.uint8)
+    log_w = np.zeros(n)
+    for i in flat.order:
+        parents = flat.parents_of(i)
+        index = BayesianNetwork.parent_rows(states, parents, flat.cards[parents], n)
+        if i in e:
+            with np.errstate(divide="ignore"):
+                log_w += np.log(flat.rows(i)[index, e[i]])
+            states[:, i] = e[i]
+        else:
+            states[:, i] = BayesianNetwork.sample_states(flat.rows(i)[index], rng.random(n))
+    return states, log_w
+
+
+def sample_worker(args):
+    """
+    Process pool entry point: attach to the shared network and sample
+    Output:
+        the counts (rejection) or log-weights (likelihood) of every state of x
+    """
+    handle, method, x, e, n, batch_size, rng = args
+    flat = attach(handle)
+    xi = flat.index[x]
+    k = int(flat.cards[xi])
+    if method == "rejection":
+        counts = np.zeros(k, dtype=np.int64)
+        for start in range(0, n, batch_size):
+            states = flat_prior_sample(flat, min(batch_size, n - start), e, rng)
+            counts += np.bincount(states[:, xi], minlength=k)
+        return counts
+    log_count = np.full(k, -np.inf)
+    for start in range(0, n, batch_size):
+        states, log_w = flat_weighted_sample(flat, min(batch_size, n - start), e, rng)
+        log_count = np.logaddexp(log_count, log_bincount(states[:, xi], log_w, k))
+    return log_count
+
+
+@instrumentation.instrumented("parallel-sampling")
+def parallel_sampling_ask(x, e, bn, n, method="likelihood", workers=4, seed=None,
+                          batch_size=100000, path=None):
+    """
+    Rejection sampling or likelihood weighting spread over worker processes
+    that share one copy of the network
+    Input:
+        x, the query variable
+        e, observed values for variables E
+        bn, a Bayesian network
+        n, the total number of samples
+        method, "rejection" or "likelihood"
+        workers, the number of worker processes
+        seed, a seed, SeedSequence or numpy Generator the independent worker
+            streams are spawned from
+        batch_size, the number of samples each worker draws at once
+        path, memory-map this file instead of using shared memory
+    Output:
+        an estimate of P(X|e)
+    """
+    e = bn.evidence_states(e)
+    rngs = np.random.default_rng(seed).spawn(workers)
+    sizes = [n // workers + (1 if w < n % workers else 0) for w in range(workers)]
+    with SharedNetwork(flatten(bn), path) as shared:
+        jobs = [(shared.handle, method, x, e, sizes[w], batch_size, rngs[w]) for w in range(workers)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(sample_worker, jobs))
+    record = instrumentation.active()
+    if record is not None:
+        record.samples += n
+    if method == "rejection":
+        return normalize(np.sum(results, axis=0).tolist())
+    return normalize(np.logaddexp.reduce(results, axis=0).tolist(), log=True)
@@ -1,129 +1,121 @@
 import BayesianNetwork
+import elimination_order
+import instrumentation
+import numpy as np
+import time
 from exact_inferencer import normalize
 import sys
 
 
-def point_wise_product(f1, f2):
+def point_wise_product(f1, f2, log=False):
     """
     Point-wise product function
     Input:
-        var, Selected hidden variable
         f1,f2, Two factors
+        log, whether the factors hold log-probabilities (the product is then a sum)
     Output:
-        the point-wise product of f1 and f2
+        the point-wise product of f1 and f2, computed by broadcasting
+        both tables over the union of their variables
     """
-    res = BayesianNetwork.Factor()
-    hidden = set(f1.hidden_val + f2.hidden_val)
-    permutation = BayesianNetwork.generate_permutation(len(hidden))
-    table = []
-    for i in range(len(permutation)):
-        record = {}
-        tmp_line = []
-        index = 0
-        prob = 1.0
-        for val in hidden:
-            record[val] = permutation[i][index]
-            index += 1
-        table1 = f1.prob_table
-        table2 = f2.prob_table
-        for line in table1:
-            if consist(record, line[0]):
-                prob *= line[1]
-        for line in table2:
-            if consist(record, line[0]):
-                prob *= line[1]
-        tmp_line.append(record)
-        tmp_line.append(prob)
-        table.append(tmp_line)
-    res.prob_table = table
-    res.hidden_val = list(hidden)
-    return res
+    variables = f1.variables + [v for v in f2.variables if v not in f1.variables]
+    if log:
+        return BayesianNetwork.Factor(variables, f1.expand(variables) + f2.expand(variables))
+    return BayesianNetwork.Factor(variables, f1.expand(variables) * f2.expand(variables))
 
 
-def sum_out(var, f):
+def sum_out(var, f, log=False):
     """
     Sum out function
     Input:
         var, the variable to be summed out
         f, a factor (the point-wise product of all factors that have var as a hidden variable)
+        log, whether f holds log-probabilities (the sum is then a log-sum-exp)
     Output:
         The summed out result of f
     """
-    res = BayesianNetwork.Factor()
-    new_hidden_vals = []
-    for val in f.hidden_val:
-        if val != var:
-            new_hidden_vals.append(val)
-    permutation = BayesianNetwork.generate_permutation(len(new_hidden_vals))
-    for i in range(len(permutation)):
-        record = {}
-        tmp_line = []
-        index = 0
-        prob = 0
-        for val in new_hidden_vals:
-            record[val] = permutation[i][index]
-            index += 1
-        for line in f.prob_table:
-            if consist(line[0], record):
-                prob += line[1]
-        tmp_line.append(record)
-        tmp_line.append(prob)
-        res.prob_table.append(tmp_line)
-        res.hidden_val = new_hidden_vals
-    return res
+    if var not in f.variables:
+        return f
+    variables = [v for v in f.variables if v != var]
+    if log:
+        return BayesianNetwork.Factor(variables, log_sum_exp(f.values, f.axis(var)))
+    return BayesianNetwork.Factor(variables, f.values.sum(axis=f.axis(var)))
 
 
-def consist(dict1, dict2):
+def log_sum_exp(values, axis):
     """
-    Input:
-        Two dictionaries (The first dictionary has larger size)
-    Output:
-        Whether dict2 is consistent with dict1
+    log(sum(exp(values), axis)), shifted by the maximum so it cannot underflow
+    """
+    m = values.max(axis=axis, keepdims=True)
+    m = np.where(np.isfinite(m), m, 0.0)
+    with np.errstate(divide="ignore"):
+        res = np.log(np.exp(values - m).sum(axis=axis, keepdims=True)) + m
+    return np.squeeze(res, axis=axis)
+
+
+def log_factor(f):
+    """
+    The factor holding the logarithms of the entries of f
     """
-    for item in dict1:
-        if item in dict2:
-            if dict1[item] != dict2[item]:
-                return False
-    return True
+    with np.errstate(divide="ignore"):
+        return BayesianNetwork.Factor(f.variables, np.log(f.values))
 
 
-def elimination_ask(x, e, bn):
+@instrumentation.instrumented("elimination")
+def elimination_ask(x, e, bn, order=None, heuristic="min-fill", log=False):
     """
     Variable Elimination function
     Input:
         X, query variable
         e, observed values for variable E
         bn, a Bayesian network
+        order, the hidden variables in elimination order (default: computed
+            with the given heuristic, see elimination_order.HEURISTICS)
+        heuristic, the elimination ordering heuristic
+        log, whether to eliminate in the log domain, which cannot underflow
     Output:
         a distribution over X
     """
-    nodes = []
-    node_list = bn.get_nodelist()
+    record = instrumentation.active()
+    if record is not None:
+        t = time.perf_counter()
+    e = bn.evidence_states(e)
     factors = []
     hidden = []
-    for node in node_list:
+    for node in bn.get_nodelist():
         node_name = node.get_name()
-        nodes.append(node_name)
-        factor = BayesianNetwork.make_factor(node, e)
-        factors.append(factor)
-    for node_name in nodes:
+        f = BayesianNetwork.make_factor(node, e)
+        factors.append(log_factor(f) if log else f)
         if node_name not in e and node_name != x:
             hidden.append(node_name)
-    index = -1
-    new_factor = factors[index]
-    if nodes[index] in hidden:
-        new_factor = sum_out(nodes[index], new_factor)
-    for index in range(-2, -len(nodes)-1, -1):
-        new_factor = point_wise_product(factors[index], new_factor)
-        if nodes[index] in hidden:
-            new_factor = sum_out(nodes[index], new_factor)
-    count = [0, 0]
-    for line in new_factor.prob_table:
-        if line[0][x]:
-            count[0] = line[1]
-        else:
-            count[1] = line[1]
-    return normalize(count)
+    if record is not None:
+        t = instrumentation.lap(record, "factor build", t)
+    if order is None:
+        order = elimination_order.elimination_order(bn, e, hidden, heuristic)[0]
+    if record is not None:
+        t = instrumentation.lap(record, "ordering", t)
+    for var in order:
+        # Only the factors that mention var take part in its elimination
+        relevant = [f for f in factors if var in f.variables]
+        factors = [f for f in factors if var not in f.variables]
+        if not relevant:
+            continue
+        new_factor = relevant[0]
+        for f in relevant[1:]:
+            new_factor = point_wise_product(new_factor, f, log)
+        if record is not None:
+            t = instrumentation.lap(record, "product", t)
+            record.factor(new_factor)
+        factors.append(sum_out(var, new_factor, log))
+        if record is not None:
+            t = instrumentation.lap(record, "sum-out", t)
+    new_factor = BayesianNetwork.Factor([], 0.0 if log else 1.0)
+    for f in factors:
+        new_factor = point_wise_product(new_factor, f, log)
+    if record is not None:
+        instrumentation.lap(record, "product", t)
+        record.factor(new_factor)
+    count = [float(v) for v in new_factor.values]
+    return normalize(count, log)
 
 
 def main():
@@ -131,12 +123,9 @@ def main():
     Variable elimination main function
     """
     file_name = sys.argv[1]
-    bn = BayesianNetwork.xml_reader(file_name, "BayesianNet")
+    bn = BayesianNetwork.load_network(file_name, "BayesianNet")
     x = sys.argv[2]
-    e = {}
-    for index in range(3, len(sys.argv), 2):
-        e[sys.argv[index]] = bool(sys.argv[index+1])
-        index += 2
+    e = BayesianNetwork.parse_evidence(bn, sys.argv[3:])
     print(elimination_ask(x, e, bn))
 
 